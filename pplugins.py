@@ -1,10 +1,50 @@
+import gc
+import os
+import sys
+import mmap
+import time
+import errno
+import heapq
+import pickle
+import signal
+import socket
+import struct
+import marshal
+import cProfile
 import logging
 import inspect
+import itertools
 import threading
 import multiprocessing
+from multiprocessing.connection import Client, Listener
 from abc import ABCMeta, abstractmethod
 
-from six import add_metaclass
+from six import add_metaclass, string_types
+from six.moves import queue
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+RESOURCE_LIMIT_EXIT_CODE = 75
+"""Exit code of a plugin process which ran out of memory or file descriptors"""
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:  # Python 2
+    _monotonic = time.time
 
 
 class PluginError(Exception):
@@ -24,307 +64,2224 @@ class PluginError(Exception):
         return "%s (plugin: %s)" % (self.args[0], self.plugin)
 
 
-class PluginInterface(object):
-    """Facilitates communication between the plugin and the parent process
+def expose(func):
+    """Decorator marking a plugin method as callable through
+    :any:`PluginManager.call()`
 
-    Attributes
+    Only exposed methods may be called by the parent process, so that a
+    manager can't invoke arbitrary attributes of the plugin object.
+    """
+    func.exposed = True
+    return func
+
+
+def handles(*event_types):
+    """Decorator registering an :any:`EventLoopPlugin` method as the handler
+    for events of the given types
+
+    Parameters
     ----------
-    events : queue.Queue
-        Event queue that messages from the parent are written to.
-    messages : queue.Queue
-        Message queue that messages can be sent back to the parent with.
+    *event_types
+        Event types, as returned by :any:`EventLoopPlugin.event_type()`.
     """
-    def __init__(self, event_queue, message_queue):
-        self.events = event_queue
-        self.messages = message_queue
+    def decorator(func):
+        func.handled_events = event_types
+        return func
 
+    return decorator
 
-@add_metaclass(ABCMeta)
-class Plugin(object):
-    """Abstract class for plugins to implement
+
+class CallRequest(object):
+    """Request to call an exposed plugin method, sent as an event
 
     Attributes
     ----------
-    interface : object
-        An instantiated :any:`PluginRunner.interface` object.
+    call_id : int
+        Identifier used to match the response to the request.
+    method : str
+        Name of the exposed plugin method to call.
+    args : tuple
+        Positional arguments to call the method with.
+    kwargs : dict
+        Keyword arguments to call the method with.
     """
+    def __init__(self, call_id, method, args, kwargs):
+        self.call_id = call_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
 
-    def __init__(self, interface):
-        self.interface = interface
-
-        # Plugins should implement the run() method
-        self.run()
 
-    @abstractmethod
-    def run(self):
-        """This method must be overridden by the plugin.
+class CallResponse(object):
+    """Response to a :any:`CallRequest`, sent back as a message
 
-        It is the called by the the constructor, and should implement an event
-        loop (using the interface as a method of communicating with the parent
-        process.)
-        """
+    Attributes
+    ----------
+    call_id : int
+        Identifier of the request this is a response to.
+    result
+        Return value of the method, if it succeeded.
+    error : str
+        Description of the error raised by the method, if it failed.
+    """
+    def __init__(self, call_id, result=None, error=None):
+        self.call_id = call_id
+        self.result = result
+        self.error = error
 
 
-@add_metaclass(ABCMeta)
-class PluginRunner(multiprocessing.Process):
-    """Finds and runs a plugin. Entry point to the child process.
+class CallFuture(object):
+    """Holds the eventual result of a call made with
+    :any:`PluginManager.call()`
 
-    :any:`run()` can be overrided to control what happens in the newly spawned
-    process. By default, it passes a new instance of the found plugin class
-    an instance of :any:`self.interface`.
+    The future is resolved by :any:`PluginManager.process_messages()`, so a
+    thread blocking on :any:`result()` relies on another thread processing
+    messages.
 
-    The `interface` property can also be overrided to control the interface
-    class that is instantiated and passed to the plugin.
+    Attributes
+    ----------
+    plugin : str
+        The plugin name the call was made to.
+    method : str
+        The name of the method that was called.
     """
+    def __init__(self, plugin, method):
+        self.plugin = plugin
+        self.method = method
 
-    interface = PluginInterface
-    """Interface class to instantiate and pass to the plugin
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
 
-    By default, we use :any:`PluginInterface`. This may be overridden.
-    """
+    def cancel(self):
+        """Cancels the call if it hasn't completed yet
 
-    plugin_class = Plugin
-    """Plugin class which must be subclassed by plugins
+        The plugin may still execute the method, but its result is discarded.
 
-    By default, we use :any:`Plugin`. This may be overridden.
-    """
+        Returns
+        -------
+        bool
+            Whether the call was cancelled.
+        """
+        return self._resolve(cancelled=True)
 
-    def __init__(self, plugin, event_queue, message_queue):
-        """Sets daemon flag to True on the process, and accepts queues.
+    def cancelled(self):
+        """Returns whether the call was cancelled
 
-        Parameters
-        ----------
-        plugin : str
-            Plugin name (loading of the plugin is handled internally.)
-        event_queue : queue.Queue
-            Some sort of Queue for events to be passed to the plugin through.
-        message_queue : queue.Queue
-            Some sort of Queue for messages to be passed to the parent through.
+        Returns
+        -------
+        bool
         """
+        return self._cancelled
 
-        super(PluginRunner, self).__init__()
+    def done(self):
+        """Returns whether the call completed, failed, or was cancelled
 
-        self.plugin = plugin
-        self.event_queue = event_queue
-        self.message_queue = message_queue
+        Returns
+        -------
+        bool
+        """
+        return self._done.is_set()
 
-        # Terminate the plugin if the plugin manager terminates
-        self.daemon = True
+    def result(self, timeout=None):
+        """Returns the return value of the call, waiting for it if necessary
 
-    def run(self):
-        """Instantiates the first Plugin subclass in the plugin's module
+        Parameters
+        ----------
+        timeout : float
+            Maximum number of seconds to wait. Waits forever if None.
 
-        Calls :any:`self.interface` with the `event_queue` and `message_queue`
-        passed to the constructor, and gives the return to the newly
-        instantiated plugin class.
+        Raises
+        ------
+        PluginError
+            If the call failed, was cancelled, or didn't complete in time.
         """
-        interface = self.interface(self.event_queue, self.message_queue)
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
 
-        cls = self._find_plugin()
+        return self._result
 
-        try:
-            cls(interface)
-        except:
-            logging.getLogger(__name__).exception(
-                "Error running plugin %s", self.plugin)
+    def exception(self, timeout=None):
+        """Returns the error raised by the call, waiting for it if necessary
 
-    def _find_plugin(self):
-        """Returns the first Plugin subclass in the plugin module.
+        Parameters
+        ----------
+        timeout : float
+            Maximum number of seconds to wait. Waits forever if None.
+
+        Returns
+        -------
+        PluginError
+            The error, or None if the call succeeded.
 
         Raises
         ------
         PluginError
-            If no subclass of Plugin is found.
+            If the call was cancelled, or didn't complete in time.
         """
-        module = self._load_plugin()
-
-        cls = None
-        for _, obj in inspect.getmembers(module, self._is_plugin):
-            cls = obj
-            break
+        if not self._done.wait(timeout):
+            raise PluginError("Timed out waiting for %s()" % self.method,
+                              self.plugin)
 
-        if cls is None:
-            raise PluginError("Unable to find a Plugin class (a class "
-                              "subclassing %s)" % self.plugin_class,
+        if self._cancelled:
+            raise PluginError("Call to %s() was cancelled" % self.method,
                               self.plugin)
 
-        return cls
+        return self._exception
 
-    def _is_plugin(self, obj):
-        """Returns whether a given object is a class extending Plugin
+    def add_done_callback(self, fn):
+        """Calls `fn` with the future once it's done
 
-        Returns
-        -------
-        bool
+        If the future is already done, `fn` is called immediately.
         """
-        return inspect.isclass(obj) and self.plugin_class in obj.__bases__
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
 
-    @abstractmethod
-    def _load_plugin(self):
-        """This method must be overridden to return a Python module.
+        fn(self)
 
-        A Plugin class should exist in the module returned by this method.
+    def _resolve(self, result=None, exception=None, cancelled=False):
+        """Sets the outcome of the call, unless it was already set
 
         Returns
         -------
-        module
-            A module containing a plugin class (a class which sub-classes
-            `self.plugin_class`.)
+        bool
+            Whether the outcome was set.
         """
+        with self._lock:
+            if self._done.is_set():
+                return False
 
+            self._result = result
+            self._exception = exception
+            self._cancelled = cancelled
+            self._done.set()
 
-@add_metaclass(ABCMeta)
-class PluginManager(object):
-    """Finds, launches, and stops plugins"""
+            callbacks, self._callbacks = self._callbacks, []
 
-    plugin_runner = PluginRunner
-    """PluginRunner class to run plugins.
+        for fn in callbacks:
+            fn(self)
 
-    By default, we use :any:`PluginRunner`. This may be overridden, but should
-    always extend `multiprocessing.Process`.
-    """
+        return True
 
-    def __init__(self):
-        self.plugins = {}
-        self.logger = logging.getLogger(__name__)
-        self.reap_lock = threading.RLock()
 
-    def __enter__(self):
-        # Reap plugin processes every 5 seconds
-        self._start_reaping_thread()
+class ProfileRequest(object):
+    """Request to profile a plugin for a while, sent as an event
 
-        return self
+    Attributes
+    ----------
+    kind : str
+        `cprofile` to profile function calls, `sample` to periodically sample
+        the stack, or `tracemalloc` to trace memory allocations.
+    duration : float
+        Number of seconds to profile for.
+    interval : float
+        Number of seconds between samples, for the `sample` profiler.
+    """
+    def __init__(self, kind, duration, interval=0.01):
+        self.kind = kind
+        self.duration = duration
+        self.interval = interval
 
-    def __exit__(self, type, value, traceback):
-        self._stop_reaping_thread()
 
-    def start_plugin(self, name):
-        """Attempt to start a new process-based plugin.
+class ProfileResult(object):
+    """Result of a :any:`ProfileRequest`, sent back as a message
 
-        Parameters
-        ----------
-        name : str
-            Plugin name to start.
-        """
-        self.reap_plugins()
+    Attributes
+    ----------
+    kind : str
+        The kind of profiler that was run.
+    data
+        Stats dictionary for `cprofile`, dictionary mapping collapsed stacks
+        to sample counts for `sample`, or a snapshot for `tracemalloc`.
+    error : str
+        Description of the reason profiling failed, if it did.
+    """
+    def __init__(self, kind, data=None, error=None):
+        self.kind = kind
+        self.data = data
+        self.error = error
 
-        # Don't run two instances of the same plugin
-        if name in self.plugins:
-            raise PluginError("Plugin is already running", name)
 
-        self.logger.info("Starting plugin %s", name)
+class StartupReport(object):
+    """Times at which a plugin process reached each phase of starting up
 
-        data = {
-            # Create an input and output queue
-            'events': multiprocessing.Queue(),
-            'messages': multiprocessing.Queue(),
-        }
+    Sent as a message once the plugin is ready to handle events.
 
-        try:
-            data['process'] = self.plugin_runner(
-                name, data['events'], data['messages'])
-        except Exception:
-            self.logger.exception("Unable to create plugin process")
-            raise
+    Attributes
+    ----------
+    started : float
+        Time the plugin process began running the plugin runner.
+    imported : float
+        Time the plugin module was loaded.
+    initialized : float
+        Time the plugin was ready to handle events.
+    """
+    def __init__(self, started, imported, initialized):
+        self.started = started
+        self.imported = imported
+        self.initialized = initialized
 
-        data['process'].start()
 
-        self.logger.info("Started plugin %s", name)
-        self.plugins[name] = data
+class StopProfiling(object):
+    """Event a plugin sends itself once it's been profiled for long enough"""
 
-    def stop_plugin(self, name):
-        """Stops a plugin process. Tries cleanly, forcefully, then gives up.
 
-        Parameters
-        ----------
-        name : string
-           Plugin name to stop.
-        """
-        self.reap_plugins()
+class _StackSampler(threading.Thread):
+    """Periodically samples the stack of a thread
 
-        self.logger.info("Stopping plugin %s", name)
+    Attributes
+    ----------
+    stacks : dict
+        Maps collapsed stacks (frames from outermost to innermost, separated
+        by semicolons) to the number of times they were sampled.
+    """
+    def __init__(self, thread_ident, interval):
+        super(_StackSampler, self).__init__()
 
-        if name not in self.plugins:
-            self.logger.info("Plugin %s isn't running", name)
-            return
+        self.thread_ident = thread_ident
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.daemon = True
 
-        # Try cleanly shutting it down
-        self._stop_plugin(name)
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_ident)
 
-        # Make sure it died or send SIGTERM
-        if self.plugins[name]['process'].is_alive():
-            self.logger.info("Forcefully killing plugin %s (SIGTERM)", name)
-            self.plugins[name]['process'].terminate()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s)" % (code.co_name, code.co_filename))
+                frame = frame.f_back
 
-        del self.plugins[name]
+            stack = ';'.join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
 
-    def process_messages(self):
-        """Handles any messages from children
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
-        Loops through every plugins messages queue and calls
-        :any:`_process_message()` for each one.
-        """
-        self.reap_plugins()
 
-        for name, plugin in self.plugins.items():
-            while not plugin['messages'].empty():
-                self._process_message(name, plugin['messages'].get())
+class PluginResources(object):
+    """Restricts the resources available to a plugin process
 
-    def reap_plugins(self):
-        """Reaps any children processes that terminated"""
-        with self.reap_lock:
-            self.logger.debug("Reaping plugin processes")
+    The restrictions are applied in the plugin process before the plugin is
+    loaded. Any restriction left as None is inherited from the parent.
 
-            # Create a new list for plugins that are still alive
-            self.plugins = {
-                name: plugin for name, plugin in self._living_plugins()
-            }
+    Attributes
+    ----------
+    cpus : set
+        CPU numbers the process may run on.
+    nice : int
+        Increment to the process niceness.
+    scheduler : tuple
+        Tuple of a scheduling policy (e.g. `os.SCHED_BATCH`) and priority.
+    rlimits : dict
+        Maps `resource.RLIMIT_*` constants to a limit, or a (soft, hard)
+        tuple of limits. A single `RLIMIT_CPU` limit is used as the soft
+        limit, with a hard limit a second later, so the process is sent
+        `SIGXCPU` rather than killed.
+    cgroup : str
+        Path to a cgroup v2 directory the process should join, which sets
+        memory and CPU quotas.
+    """
+    def __init__(self, cpus=None, nice=None, scheduler=None, rlimits=None,
+                 cgroup=None):
+        self.cpus = cpus
+        self.nice = nice
+        self.scheduler = scheduler
+        self.rlimits = rlimits or {}
+        self.cgroup = cgroup
 
-    def _living_plugins(self):
-        """Checks all plugins to see if they're alive, yields living plugins
+    def apply(self):
+        """Applies the restrictions to the current process
 
-        Yields
+        Raises
         ------
-        tuple
-            Tuple containing plugin name and plugin dictionary
+        OSError
+            If a restriction isn't supported or permitted.
         """
-        for name, plugin in self.plugins.items():
-            # Don't add dead processes to our new plugin list
-            if not plugin['process'].is_alive():
-                self.logger.warning("Plugin %s terminated unexpectedly", name)
-                continue
+        if self.cgroup is not None:
+            with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as f:
+                f.write(str(os.getpid()))
 
-            yield (name, plugin)
+        if self.cpus is not None:
+            os.sched_setaffinity(0, self.cpus)
 
-    def _start_reaping_thread(self):
-        self.reap_timer = threading.Timer(5, self.reap_plugins)
-        self.reap_timer.start()
+        if self.nice is not None:
+            os.nice(self.nice)
 
-    def _stop_reaping_thread(self):
-        self.reap_timer.cancel()
-        self.reap_timer.join()
+        if self.scheduler is not None:
+            policy, priority = self.scheduler
+            os.sched_setscheduler(0, policy, os.sched_param(priority))
 
-    @abstractmethod
-    def _stop_plugin(self, plugin):
-        """This method must be overridden to send a clean shutdown signal.
+        for limit, value in self.rlimits.items():
+            if isinstance(value, tuple):
+                resource.setrlimit(limit, value)
+                continue
 
-        Parameters
-        ----------
-        plugin : str
-            The name of the plugin to stop
-        """
+            hard = value
+            if limit == resource.RLIMIT_CPU and \
+                    value != resource.RLIM_INFINITY:
+                # The kernel sends SIGKILL at the hard limit, and only sends
+                # SIGXCPU if the soft limit is lower
+                hard = value + 1
 
-    def _process_message(self, plugin, message):
-        """This method should be overridden by subclasses.
+                current = resource.getrlimit(limit)[1]
+                if current != resource.RLIM_INFINITY:
+                    hard = min(hard, current)
 
-        Processes a message from a plugin.
+            resource.setrlimit(limit, (value, hard))
 
-        Parameters
-        ----------
-        plugin : str
-            The name of the plugin that sent the message
+
+class PluginInterface(object):
+    """Facilitates communication between the plugin and the parent process
+
+    Attributes
+    ----------
+    events : queue.Queue
+        Event queue that messages from the parent are written to.
+    messages : queue.Queue
+        Message queue that messages can be sent back to the parent with.
+    shared_data : dict
+        Maps names of data shared by the parent to a tuple of how it's shared
+        (`file` or `memory`), and where.
+    """
+    def __init__(self, event_queue, message_queue, shared_data=None):
+        self.events = event_queue
+        self.messages = message_queue
+        self.shared_data = shared_data or {}
+
+        # Attached shared data, mapped by name to (buffer, handle)
+        self._attached = {}
+
+        # Start up times set by the plugin runner, until they're reported
+        self.startup = None
+
+    def report_startup(self):
+        """Sends the parent the time taken by each phase of starting up
+
+        Called by :any:`Plugin.report_ready()`. Does nothing if there's
+        nothing to report.
+        """
+        if self.startup is None:
+            return
+
+        started, imported = self.startup
+        self.startup = None
+
+        self.messages.put(StartupReport(started, imported, time.time()))
+
+    def attach(self, name):
+        """Returns a read-only buffer of data shared by the parent
+
+        The data isn't copied, so every plugin attached to it shares the same
+        memory.
+
+        Parameters
+        ----------
+        name : str
+            Name the data was shared with by :any:`PluginManager.share_data()`.
+
+        Returns
+        -------
+        mmap.mmap or memoryview
+
+        Raises
+        ------
+        KeyError
+            If no data was shared with the name.
+        """
+        if name not in self._attached:
+            kind, location = self.shared_data[name]
+
+            if kind == 'file':
+                with open(location, 'rb') as f:
+                    handle = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                buf = handle
+            else:
+                handle = shared_memory.SharedMemory(name=location)
+                buf = handle.buf.toreadonly()
+
+            self._attached[name] = (buf, handle)
+
+        return self._attached[name][0]
+
+    def detach(self):
+        """Releases all attached shared data
+
+        Buffers returned by :any:`attach()` can't be used afterwards. Called by
+        :any:`PluginRunner.run()` once the plugin returns.
+        """
+        attached, self._attached = self._attached, {}
+
+        for buf, handle in attached.values():
+            try:
+                if isinstance(buf, memoryview):
+                    buf.release()
+
+                handle.close()
+            except BufferError:
+                # The plugin still holds a view of the data
+                logging.getLogger(__name__).debug(
+                    "Unable to release shared data")
+
+
+@add_metaclass(ABCMeta)
+class Plugin(object):
+    """Abstract class for plugins to implement
+
+    Attributes
+    ----------
+    interface : object
+        An instantiated :any:`PluginRunner.interface` object.
+    """
+
+    control_events = (CallRequest, ProfileRequest, StopProfiling)
+    """Types of the events handled by :any:`handle_control()`"""
+
+    reports_ready = False
+    """Whether the plugin calls :any:`report_ready()` itself
+
+    Otherwise, the plugin is considered ready as soon as :any:`run()` is
+    called.
+    """
+
+    def __init__(self, interface):
+        self.interface = interface
+
+        # Tuple of the kind of profiler running, and the profiler
+        self._profiler = None
+
+        if not self.reports_ready:
+            self.report_ready()
+
+        # Plugins should implement the run() method
+        self.run()
+
+    def report_ready(self):
+        """Reports how long the plugin took to start up
+
+        Plugins which set :any:`reports_ready` should call this once they're
+        set up, before waiting for their first event. Only the first call
+        has an effect.
+        """
+        # Custom interfaces may not report startup times
+        report_startup = getattr(self.interface, 'report_startup', None)
+        if report_startup is not None:
+            report_startup()
+
+    def handle_control(self, event):
+        """Handles events sent by the framework rather than the application
+
+        Plugins should pass every event they receive to this method from
+        their event loop, and skip events for which it returns True.
+
+        Parameters
+        ----------
+        event
+            An event read from the interface's event queue.
+
+        Returns
+        -------
+        bool
+            Whether the event was handled.
+        """
+        if isinstance(event, CallRequest):
+            self._handle_call(event)
+            return True
+
+        if isinstance(event, ProfileRequest):
+            self._start_profiling(event)
+            return True
+
+        if isinstance(event, StopProfiling):
+            self._stop_profiling()
+            return True
+
+        return False
+
+    def _handle_call(self, request):
+        """Calls an exposed method and sends the response to the parent
+
+        Parameters
+        ----------
+        request : CallRequest
+            The call to make.
+        """
+        method = getattr(self, request.method, None)
+        if not getattr(method, 'exposed', False):
+            response = CallResponse(
+                request.call_id,
+                error="No exposed method named %s" % request.method)
+        else:
+            try:
+                response = CallResponse(
+                    request.call_id,
+                    result=method(*request.args, **request.kwargs))
+            except Exception as e:
+                logging.getLogger(__name__).exception(
+                    "Error handling call to %s()", request.method)
+                response = CallResponse(
+                    request.call_id, error="%s: %s" % (type(e).__name__, e))
+
+        self.interface.messages.put(response)
+
+    def _start_profiling(self, request):
+        """Starts profiling, and schedules it to stop after a while
+
+        Profiling is stopped by sending :any:`StopProfiling` to the plugin's
+        own event queue, so that the profiler is stopped by the thread that
+        started it.
+
+        Parameters
+        ----------
+        request : ProfileRequest
+            The kind and duration of profiling to run.
+        """
+        if self._profiler is not None:
+            error = "Already profiling"
+        elif request.kind == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            error = None
+        elif request.kind == 'sample':
+            profiler = _StackSampler(threading.current_thread().ident,
+                                     request.interval)
+            profiler.start()
+            error = None
+        elif request.kind == 'tracemalloc' and tracemalloc is not None:
+            tracemalloc.start()
+            profiler = tracemalloc
+            error = None
+        else:
+            error = "Unsupported profiler %s" % request.kind
+
+        if error is not None:
+            self.interface.messages.put(
+                ProfileResult(request.kind, error=error))
+            return
+
+        self._profiler = (request.kind, profiler)
+
+        timer = threading.Timer(request.duration, self.interface.events.put,
+                                args=(StopProfiling(),))
+        timer.daemon = True
+        timer.start()
+
+    def _stop_profiling(self):
+        """Stops profiling, and sends the results to the parent"""
+        if self._profiler is None:
+            return
+
+        kind, profiler = self._profiler
+        self._profiler = None
+
+        if kind == 'cprofile':
+            profiler.disable()
+            profiler.create_stats()
+            data = profiler.stats
+        elif kind == 'sample':
+            profiler.stop()
+            data = profiler.stacks
+        else:
+            data = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        self.interface.messages.put(ProfileResult(kind, data))
+
+    @abstractmethod
+    def run(self):
+        """This method must be overridden by the plugin.
+
+        It is the called by the the constructor, and should implement an event
+        loop (using the interface as a method of communicating with the parent
+        process.)
+        """
+
+
+class EventLoopPlugin(Plugin):
+    """Plugin which runs an event loop, dispatching events to handlers
+
+    Handlers are methods decorated with :any:`handles`, and are looked up by
+    the type of each event. Events sent by the framework are handled by
+    :any:`Plugin.handle_control()`, and the loop returns once it receives a
+    stop event. The loop blocks while waiting for events, waking up only to
+    call :any:`tick()`.
+    """
+
+    reports_ready = True
+    """Ready once :any:`run()` is about to wait for the first event."""
+
+    tick_interval = None
+    """Seconds between calls to :any:`tick()`, or None to never call it."""
+
+    batch_size = 1
+    """Maximum number of waiting events passed to :any:`handle_batch()`."""
+
+    def __init__(self, interface):
+        # Map event types to bound handler methods
+        self.handlers = {}
+        for cls in reversed(type(self).__mro__):
+            for name, attr in vars(cls).items():
+                for event_type in getattr(attr, 'handled_events', ()):
+                    self.handlers[event_type] = getattr(self, name)
+
+        super(EventLoopPlugin, self).__init__(interface)
+
+    def run(self):
+        """Handles events until a stop event is received"""
+        events = self.interface.events
+        next_tick = None
+        if self.tick_interval is not None:
+            next_tick = _monotonic() + self.tick_interval
+
+        self.report_ready()
+
+        while True:
+            if next_tick is None:
+                timeout = None
+            else:
+                timeout = max(0, next_tick - _monotonic())
+
+            batch = []
+            try:
+                batch.append(events.get(timeout=timeout))
+
+                # Leave events sent after a stop event in the queue
+                while len(batch) < self.batch_size and \
+                        not self.is_stop_event(batch[-1]):
+                    batch.append(events.get_nowait())
+            except queue.Empty:
+                pass
+
+            if batch and not self._handle_events(batch):
+                return
+
+            if next_tick is not None and _monotonic() >= next_tick:
+                self.tick()
+                next_tick = _monotonic() + self.tick_interval
+
+    def event_type(self, event):
+        """Returns the type handlers are looked up by for an event
+
+        By default, this is the class of the event. This may be overridden,
+        e.g. to dispatch on a field of the event.
+        """
+        return type(event)
+
+    def is_stop_event(self, event):
+        """Returns whether an event should stop the loop
+
+        By default, `None` stops the loop. This may be overridden.
+        """
+        return event is None
+
+    def handle_batch(self, events):
+        """Handles application events waiting at the same time
+
+        By default, each event is passed to its handler. This may be
+        overridden to handle events together.
+
+        Parameters
+        ----------
+        events : list
+            Up to :any:`batch_size` events, in the order they were sent.
+        """
+        handlers = self.handlers
+        for event in events:
+            handler = handlers.get(self.event_type(event))
+
+            if handler is None:
+                self.handle_unknown(event)
+            else:
+                handler(event)
+
+    def handle_unknown(self, event):
+        """Handles an event no handler is registered for
+
+        By default, the event is ignored. This may be overridden.
+        """
+        logging.getLogger(__name__).debug(
+            "No handler for event type %s", self.event_type(event))
+
+    def tick(self):
+        """Called every :any:`tick_interval` seconds. May be overridden."""
+
+    def _handle_events(self, batch):
+        """Handles a batch of events in order, up to a stop event
+
+        Returns
+        -------
+        bool
+            False if a stop event was received.
+        """
+        events = []
+        for event in batch:
+            if self.is_stop_event(event):
+                if events:
+                    self.handle_batch(events)
+
+                return False
+
+            if not isinstance(event, self.control_events):
+                events.append(event)
+                continue
+
+            # Handle the events sent before this one first
+            if events:
+                self.handle_batch(events)
+                events = []
+
+            self.handle_control(event)
+
+        if events:
+            self.handle_batch(events)
+
+        return True
+
+
+@add_metaclass(ABCMeta)
+class PluginRunner(multiprocessing.Process):
+    """Finds and runs a plugin. Entry point to the child process.
+
+    :any:`run()` can be overrided to control what happens in the newly spawned
+    process. By default, it passes a new instance of the found plugin class
+    an instance of :any:`self.interface`.
+
+    The `interface` property can also be overrided to control the interface
+    class that is instantiated and passed to the plugin.
+    """
+
+    interface = PluginInterface
+    """Interface class to instantiate and pass to the plugin
+
+    By default, we use :any:`PluginInterface`. This may be overridden. It's
+    called with the event and message queues, and shared data is then set
+    on instances of :any:`PluginInterface`.
+    """
+
+    plugin_class = Plugin
+    """Plugin class which must be subclassed by plugins
+
+    By default, we use :any:`Plugin`. This may be overridden.
+    """
+
+    def __init__(self, plugin, event_queue, message_queue, resources=None,
+                 shared_data=None, start_method=None):
+        """Sets daemon flag to True on the process, and accepts queues.
+
+        Parameters
+        ----------
+        plugin : str
+            Plugin name (loading of the plugin is handled internally.)
+        event_queue : queue.Queue
+            Some sort of Queue for events to be passed to the plugin through.
+        message_queue : queue.Queue
+            Some sort of Queue for messages to be passed to the parent through.
+        resources : PluginResources
+            Restrictions to apply to the process before loading the plugin.
+        shared_data : dict
+            Data shared by the parent, passed on to the interface.
+        start_method : str
+            Method to start the process with (`fork`, `spawn` or
+            `forkserver`), or None to use the default method.
+        """
+
+        super(PluginRunner, self).__init__()
+
+        self.plugin = plugin
+        self.event_queue = event_queue
+        self.message_queue = message_queue
+        self.resources = resources
+        self.shared_data = shared_data
+        self.start_method = start_method
+
+        # Terminate the plugin if the plugin manager terminates
+        self.daemon = True
+
+    def run(self):
+        """Instantiates the first Plugin subclass in the plugin's module
+
+        Calls :any:`self.interface` with the `event_queue` and `message_queue`
+        passed to the constructor, and gives the return to the newly
+        instantiated plugin class.
+
+        If the plugin runs out of memory or file descriptors, the process
+        exits with :any:`RESOURCE_LIMIT_EXIT_CODE`.
+        """
+        started = time.time()
+
+        if self.resources is not None:
+            self.resources.apply()
+
+        interface = self.interface(self.event_queue, self.message_queue)
+
+        # Set after construction, so subclasses taking only the queues work
+        if isinstance(interface, PluginInterface):
+            interface.shared_data = self.shared_data or {}
+            if not hasattr(interface, '_attached'):
+                interface._attached = {}
+
+        cls = None
+        try:
+            # Importing the plugin may also exceed its resource limits
+            cls = self._find_plugin()
+            if isinstance(interface, PluginInterface):
+                interface.startup = (started, time.time())
+
+            cls(interface)
+        except:
+            error = sys.exc_info()[1]
+            exceeded = isinstance(error, MemoryError) or \
+                getattr(error, 'errno', None) == errno.EMFILE
+
+            # Errors loading the plugin are raised, unless caused by a limit
+            if cls is None and not exceeded:
+                raise
+
+            logging.getLogger(__name__).exception(
+                "Error running plugin %s", self.plugin)
+
+            if exceeded:
+                sys.exit(RESOURCE_LIMIT_EXIT_CODE)
+        finally:
+            if isinstance(interface, PluginInterface):
+                interface.detach()
+
+    def _Popen(self, process_obj):
+        # Start the process using the start method given to the constructor
+        # rather than the default one
+        return self._context().Process._Popen(process_obj)
+
+    def _after_fork(self):
+        return self._context().Process._after_fork()
+
+    def _context(self):
+        if self.start_method is None:
+            return multiprocessing.get_context()
+
+        return multiprocessing.get_context(self.start_method)
+
+    def _find_plugin(self):
+        """Returns the first Plugin subclass in the plugin module.
+
+        Raises
+        ------
+        PluginError
+            If no subclass of Plugin is found.
+        """
+        module = self._load_plugin()
+
+        cls = None
+        for _, obj in inspect.getmembers(module, self._is_plugin):
+            cls = obj
+            break
+
+        if cls is None:
+            raise PluginError("Unable to find a Plugin class (a class "
+                              "subclassing %s)" % self.plugin_class,
+                              self.plugin)
+
+        return cls
+
+    def _is_plugin(self, obj):
+        """Returns whether a given object is a class extending Plugin
+
+        Classes directly extending a plugin base class provided by pplugins,
+        such as :any:`EventLoopPlugin`, also count.
+
+        Returns
+        -------
+        bool
+        """
+        if not inspect.isclass(obj) or obj.__module__ == __name__:
+            return False
+
+        return any(
+            base is self.plugin_class or (
+                base.__module__ == __name__ and
+                issubclass(base, self.plugin_class))
+            for base in obj.__bases__
+        )
+
+    @abstractmethod
+    def _load_plugin(self):
+        """This method must be overridden to return a Python module.
+
+        A Plugin class should exist in the module returned by this method.
+
+        Returns
+        -------
+        module
+            A module containing a plugin class (a class which sub-classes
+            `self.plugin_class`.)
+        """
+
+
+class TrafficRecorder(object):
+    """Writes events sent to plugins and messages received from them to a log
+
+    Each record is a header containing the time it was recorded, whether it's
+    an event or a message, and the lengths of the plugin name and pickled
+    object, followed by the name and object. Read recordings with
+    :any:`read_recording()`.
+
+    Records are written to disk at least every :any:`flush_interval` seconds
+    while recording, so a log is usable even if the manager crashes.
+    """
+
+    flush_interval = 1.0
+    """Maximum number of seconds records are buffered for"""
+
+    EVENT = 0
+    """Direction of events sent to a plugin"""
+
+    MESSAGE = 1
+    """Direction of messages received from a plugin"""
+
+    MAGIC = b'PPLR\x01'
+    HEADER = struct.Struct('<dBHI')
+
+    def __init__(self, path):
+        """Opens the log, overwriting it if it exists.
+
+        Parameters
+        ----------
+        path : str
+            Path to write the log to.
+        """
+        self.file = open(path, 'wb')
+        self.file.write(self.MAGIC)
+        self.lock = threading.Lock()
+
+        self._next_flush = _monotonic() + self.flush_interval
+
+    def record(self, direction, plugin, obj):
+        """Writes an event or message to the log
+
+        Parameters
+        ----------
+        direction : int
+            :any:`EVENT` or :any:`MESSAGE`.
+        plugin : str
+            Name of the plugin the object was sent to or received from.
+        obj
+            The event or message.
+        """
+        name = plugin.encode('utf-8')
+        payload = pickle.dumps(obj, 2)
+        header = self.HEADER.pack(time.time(), direction, len(name),
+                                  len(payload))
+
+        with self.lock:
+            # Recording may have been stopped by another thread
+            if self.file.closed:
+                return
+
+            self.file.write(header + name + payload)
+
+            now = _monotonic()
+            if now >= self._next_flush:
+                self.file.flush()
+                self._next_flush = now + self.flush_interval
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path):
+    """Reads a log written by :any:`TrafficRecorder`
+
+    Parameters
+    ----------
+    path : str
+        Path to the log.
+
+    A record cut short, e.g. because the manager crashed while recording,
+    ends the log.
+
+    Yields
+    ------
+    tuple
+        Tuple of the time it was recorded, direction, plugin name, and event
+        or message.
+
+    Raises
+    ------
+    ValueError
+        If the file isn't a log written by :any:`TrafficRecorder`.
+    """
+    header = TrafficRecorder.HEADER
+
+    with open(path, 'rb') as f:
+        if f.read(len(TrafficRecorder.MAGIC)) != TrafficRecorder.MAGIC:
+            raise ValueError("%s is not a pplugins recording" % path)
+
+        while True:
+            data = f.read(header.size)
+            if len(data) < header.size:
+                break
+
+            timestamp, direction, name_length, length = header.unpack(data)
+            name = f.read(name_length)
+            payload = f.read(length)
+            if len(name) < name_length or len(payload) < length:
+                break
+
+            yield (timestamp, direction, name.decode('utf-8'),
+                   pickle.loads(payload))
+
+
+@add_metaclass(ABCMeta)
+class PluginManager(object):
+    """Finds, launches, and stops plugins"""
+
+    plugin_runner = PluginRunner
+    """PluginRunner class to run plugins.
+
+    By default, we use :any:`PluginRunner`. This may be overridden, but should
+    always extend `multiprocessing.Process`.
+    """
+
+    profile_dir = '.'
+    """Directory that profiling results are saved to."""
+
+    freeze_gc = False
+    """Whether to freeze the garbage collector before forking plugins
+
+    Objects created before a plugin is forked are then ignored by the garbage
+    collector in both processes, so memory pages shared with the parent
+    aren't copied when the collector touches them. The parent collects
+    garbage before the first freeze, stays frozen while it has plugins, and
+    unfreezes once they've all stopped. Has no effect unless plugins are
+    started with the `fork` method. Requires Python 3.7+.
+    """
+
+    def __init__(self, context=None, preload=None):
+        """Accepts the multiprocessing context to create plugins with.
+
+        Parameters
+        ----------
+        context : str or multiprocessing.context.BaseContext
+            Context, or start method (`fork`, `spawn` or `forkserver`), to
+            create plugin processes and queues with. The default start method
+            is used if None. Requires Python 3.4+.
+        preload : list
+            Names of modules the forkserver should import before forking
+            plugins, so each plugin doesn't import them again. The forkserver
+            is shared by every manager in the process, so this only has an
+            effect before the first plugin is started with it.
+        """
+        if isinstance(context, string_types):
+            context = multiprocessing.get_context(context)
+
+        # The multiprocessing module acts as the default context
+        self.context = context or multiprocessing
+        self.start_method = context.get_start_method() if context else None
+
+        if preload:
+            self.context.set_forkserver_preload(list(preload))
+
+        self.plugins = {}
+        self.logger = logging.getLogger(__name__)
+        self.reap_lock = threading.RLock()
+
+        # Data shared with plugins, mapped by name to (kind, location)
+        self.shared_data = {}
+        self._shared_memory = {}
+
+        # Records traffic to and from plugins while recording
+        self.recorder = None
+
+        # Whether the garbage collector was frozen to start plugins
+        self._gc_frozen = False
+
+        # Calls awaiting a response, mapped by call ID to their future, and
+        # a heap of (deadline, call ID) for calls with a timeout
+        self.calls = {}
+        self.call_lock = threading.Lock()
+        self._call_ids = itertools.count()
+        self._deadlines = []
+
+    def __enter__(self):
+        # Reap plugin processes every 5 seconds
+        self._start_reaping_thread()
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_reaping_thread()
+
+        for name in list(self._shared_memory):
+            self.unshare_data(name)
+
+        self.stop_recording()
+
+    def start_plugin(self, name, resources=None):
+        """Attempt to start a new process-based plugin.
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to start.
+        resources : PluginResources
+            Restrictions on the resources available to the plugin.
+        """
+        self.reap_plugins()
+
+        # Don't run two instances of the same plugin
+        if name in self.plugins:
+            raise PluginError("Plugin is already running", name)
+
+        self.logger.info("Starting plugin %s", name)
+
+        try:
+            data = self._create_plugin(name, resources)
+        except Exception:
+            self.logger.exception("Unable to create plugin process")
+            raise
+
+        # Only forked plugins share the parent's memory
+        if self.freeze_gc and hasattr(gc, 'freeze') and \
+                (self.start_method or
+                 multiprocessing.get_start_method()) == 'fork':
+            if not self._gc_frozen:
+                # Collect once, rather than keep garbage while plugins run
+                gc.collect()
+                self._gc_frozen = True
+
+            gc.freeze()
+
+        data['start_time'] = time.time()
+        data['process'].start()
+
+        self.logger.info("Started plugin %s", name)
+        self.plugins[name] = data
+
+    def stop_plugin(self, name):
+        """Stops a plugin process. Tries cleanly, forcefully, then gives up.
+
+        Parameters
+        ----------
+        name : string
+           Plugin name to stop.
+        """
+        self.reap_plugins()
+
+        self.logger.info("Stopping plugin %s", name)
+
+        if name not in self.plugins:
+            self.logger.info("Plugin %s isn't running", name)
+            return
+
+        # Try cleanly shutting it down
+        self._stop_plugin(name)
+
+        # Make sure it died or send SIGTERM
+        if self.plugins[name]['process'].is_alive():
+            self.logger.info("Forcefully killing plugin %s (SIGTERM)", name)
+            self.plugins[name]['process'].terminate()
+
+        del self.plugins[name]
+        self._fail_calls(name, "Plugin was stopped")
+        self._thaw_gc()
+
+    def send_event(self, name, event):
+        """Sends an event to a plugin, recording it if recording
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to send the event to.
+        event
+            Any pickle-able object.
+        """
+        if self.recorder is not None:
+            self.recorder.record(TrafficRecorder.EVENT, name, event)
+
+        self.plugins[name]['events'].put(event)
+
+    def start_recording(self, path):
+        """Records events sent to plugins and messages received from them
+
+        Only events sent with :any:`send_event()` or :any:`call()` are
+        recorded. Recordings can be replayed against a plugin with
+        `python -m pplugins_replay`.
+
+        Parameters
+        ----------
+        path : str
+            Path to write the recording to.
+        """
+        self.stop_recording()
+
+        self.logger.info("Recording plugin traffic to %s", path)
+        self.recorder = TrafficRecorder(path)
+
+    def stop_recording(self):
+        """Stops recording, if recording"""
+        recorder, self.recorder = self.recorder, None
+
+        if recorder is not None:
+            recorder.close()
+
+    def call(self, name, method, *args, **kwargs):
+        """Calls an exposed method of a plugin without waiting for it
+
+        Any number of calls may be in flight at once. Responses are matched
+        to their futures by :any:`process_messages()`.
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to call.
+        method : str
+            Name of the method to call. It must be decorated with
+            :any:`expose`.
+        *args
+            Positional arguments to call the method with.
+        timeout : float
+            Keyword-only. Seconds after which the call fails if no response
+            has been processed. Never times out if None (the default.)
+        **kwargs
+            Keyword arguments to call the method with.
+
+        Returns
+        -------
+        CallFuture
+            Future resolved once the plugin responds.
+
+        Raises
+        ------
+        PluginError
+            If the plugin isn't running.
+        """
+        timeout = kwargs.pop('timeout', None)
+
+        if name not in self.plugins:
+            raise PluginError("Plugin isn't running", name)
+
+        call_id = next(self._call_ids)
+        future = CallFuture(name, method)
+
+        with self.call_lock:
+            self.calls[call_id] = future
+
+            if timeout is not None:
+                heapq.heappush(self._deadlines,
+                               (_monotonic() + timeout, call_id))
+
+        # Forget the call as soon as it's cancelled
+        future.add_done_callback(lambda _: self._forget_call(call_id))
+
+        try:
+            self.send_event(name, CallRequest(call_id, method, args, kwargs))
+        except Exception as e:
+            # The plugin will never respond
+            future._resolve(exception=e)
+            raise
+
+        return future
+
+    def share_data(self, name, path=None, data=None):
+        """Shares read-only data with plugins started from now on
+
+        Plugins attach to the data with :any:`PluginInterface.attach()`,
+        without copying it.
+
+        Parameters
+        ----------
+        name : str
+            Name plugins attach to the data with.
+        path : str
+            File to memory-map in plugins.
+        data : bytes
+            Data to copy into a shared memory block. Requires Python 3.8+.
+        """
+        if (path is None) == (data is None):
+            raise ValueError("Either path or data must be given")
+
+        self.unshare_data(name)
+
+        if path is not None:
+            self.shared_data[name] = ('file', os.path.abspath(path))
+            return
+
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[:len(data)] = data
+
+        self._shared_memory[name] = block
+        self.shared_data[name] = ('memory', block.name)
+
+    def unshare_data(self, name):
+        """Stops sharing data with plugins started from now on
+
+        Shared memory blocks are freed once running plugins detach from them.
+
+        Parameters
+        ----------
+        name : str
+            Name the data was shared with.
+        """
+        self.shared_data.pop(name, None)
+
+        block = self._shared_memory.pop(name, None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    def memory_usage(self, name):
+        """Returns the memory used by a plugin process
+
+        Unique set size (USS) is memory used only by the plugin, which would
+        be freed if it stopped. Proportional set size (PSS) additionally
+        counts a share of the memory shared with other processes. Requires
+        Linux 4.14+.
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to measure.
+
+        Returns
+        -------
+        dict
+            Maps `rss`, `pss` and `uss` to a number of bytes, or None if the
+            memory usage couldn't be read.
+        """
+        pid = getattr(self.plugins[name]['process'], 'pid', None)
+        if pid is None:
+            return None
+
+        try:
+            with open('/proc/%d/smaps_rollup' % pid) as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return None
+
+        fields = {}
+        for line in lines[1:]:
+            key, value = line.split(':', 1)
+            fields[key] = int(value.split()[0]) * 1024
+
+        return {
+            'rss': fields['Rss'],
+            'pss': fields['Pss'],
+            'uss': fields['Private_Clean'] + fields['Private_Dirty'],
+        }
+
+    def profile_plugin(self, name, kind='cprofile', duration=10,
+                       interval=0.01):
+        """Profiles a running plugin for a while
+
+        The results are saved to :any:`profile_dir` when they're received by
+        :any:`process_messages()`. The plugin must pass its events to
+        :any:`Plugin.handle_control()`.
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to profile.
+        kind : str
+            `cprofile` to profile function calls, saved as pstats; `sample` to
+            periodically sample the stack, saved as collapsed stacks for
+            flame graphs; or `tracemalloc` to trace memory allocations, saved
+            as a snapshot.
+        duration : float
+            Number of seconds to profile for.
+        interval : float
+            Number of seconds between samples, for the `sample` profiler.
+
+        Raises
+        ------
+        PluginError
+            If the plugin isn't running.
+        """
+        if name not in self.plugins:
+            raise PluginError("Plugin isn't running", name)
+
+        self.logger.info("Profiling plugin %s with %s for %s seconds",
+                         name, kind, duration)
+
+        self.plugins[name]['events'].put(
+            ProfileRequest(kind, duration, interval))
+
+    def process_messages(self):
+        """Handles any messages from children
+
+        Loops through every plugins messages queue and calls
+        :any:`_process_message()` for each one. Responses to calls made with
+        :any:`call()` resolve their futures instead, profiling results are
+        saved, and calls which have timed out are failed.
+        """
+        self.reap_plugins()
+
+        for name, plugin in self.plugins.items():
+            while not plugin['messages'].empty():
+                message = plugin['messages'].get()
+
+                if self.recorder is not None:
+                    self.recorder.record(TrafficRecorder.MESSAGE, name,
+                                         message)
+
+                if isinstance(message, CallResponse):
+                    self._resolve_call(name, message)
+                elif isinstance(message, StartupReport):
+                    self._record_startup(name, message)
+                elif isinstance(message, ProfileResult):
+                    self._save_profile(name, message)
+                else:
+                    self._process_message(name, message)
+
+        self._expire_calls()
+
+    def reap_plugins(self):
+        """Reaps any children processes that terminated"""
+        with self.reap_lock:
+            self.logger.debug("Reaping plugin processes")
+
+            # Create a new list for plugins that are still alive
+            self.plugins = {
+                name: plugin for name, plugin in self._living_plugins()
+            }
+
+            self._thaw_gc()
+
+    def _create_plugin(self, name, resources=None):
+        """Creates the queues and process for a plugin, without starting it
+
+        Parameters
+        ----------
+        name : str
+            Plugin name to create.
+        resources : PluginResources
+            Restrictions on the resources available to the plugin.
+
+        Returns
+        -------
+        dict
+            Plugin dictionary containing the `events` and `messages` queues,
+            and the `process`.
+        """
+        data = {
+            # Create an input and output queue
+            'events': self.context.Queue(),
+            'messages': self.context.Queue(),
+        }
+
+        data['process'] = self.plugin_runner(
+            name, data['events'], data['messages'], resources=resources,
+            shared_data=dict(self.shared_data),
+            start_method=self.start_method)
+
+        return data
+
+    def _thaw_gc(self):
+        """Unfreezes the garbage collector once no plugins are running"""
+        if self._gc_frozen and not self.plugins:
+            gc.unfreeze()
+            self._gc_frozen = False
+
+    def _living_plugins(self):
+        """Checks all plugins to see if they're alive, yields living plugins
+
+        Yields
+        ------
+        tuple
+            Tuple containing plugin name and plugin dictionary
+        """
+        for name, plugin in self.plugins.items():
+            # Don't add dead processes to our new plugin list
+            if not plugin['process'].is_alive():
+                if self._exceeded_resources(plugin['process'].exitcode):
+                    reason = "Plugin exceeded a resource limit"
+                else:
+                    reason = "Plugin terminated unexpectedly"
+
+                self.logger.warning("%s (plugin: %s, exit code: %s)",
+                                    reason, name, plugin['process'].exitcode)
+                self._fail_calls(name, reason)
+                continue
+
+            yield (name, plugin)
+
+    def _exceeded_resources(self, exitcode):
+        """Returns whether an exit code means a resource limit was exceeded
+
+        Running out of memory or file descriptors is reported by
+        :any:`PluginRunner.run()`, and exceeding `RLIMIT_CPU` kills the
+        process with `SIGXCPU`. Processes killed by the cgroup OOM killer
+        can't be told apart from processes killed by other signals.
+
+        Returns
+        -------
+        bool
+        """
+        if hasattr(signal, 'SIGXCPU') and exitcode == -signal.SIGXCPU:
+            return True
+
+        return exitcode == RESOURCE_LIMIT_EXIT_CODE
+
+    def _resolve_call(self, plugin, response):
+        """Resolves the future of a call with the plugin's response
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin that sent the response
+        response : CallResponse
+            The response to resolve the call with
+        """
+        with self.call_lock:
+            future = self.calls.pop(response.call_id, None)
+
+        # The call was cancelled, timed out, or made by another manager
+        if future is None:
+            self.logger.debug("Discarding response to unknown call %s",
+                              response.call_id)
+            return
+
+        if response.error is not None:
+            future._resolve(exception=PluginError(response.error, plugin))
+        else:
+            future._resolve(result=response.result)
+
+    def _record_startup(self, plugin, report):
+        """Records how long each phase of starting a plugin took
+
+        The durations in seconds are stored in the plugin's `startup`
+        dictionary: `spawn` is the time taken to create the process, `import`
+        to load the plugin module, and `init` for the plugin to be ready to
+        handle events.
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin that started
+        report : StartupReport
+            The times the plugin reached each phase
+        """
+        data = self.plugins[plugin]
+        data['startup'] = {
+            'spawn': report.started - data['start_time'],
+            'import': report.imported - report.started,
+            'init': report.initialized - report.imported,
+        }
+
+        self.logger.debug("Plugin %s started in %.3fs", plugin,
+                          report.initialized - data['start_time'])
+
+    def _save_profile(self, plugin, result):
+        """Saves profiling results to :any:`profile_dir`
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin that was profiled
+        result : ProfileResult
+            The results to save
+        """
+        if result.error is not None:
+            self.logger.warning("Unable to profile plugin %s: %s",
+                                plugin, result.error)
+            return
+
+        extension = {
+            'cprofile': 'pstats',
+            'sample': 'collapsed',
+            'tracemalloc': 'tracemalloc',
+        }[result.kind]
+        path = os.path.join(self.profile_dir, "%s-%s.%s" % (
+            plugin, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+        if result.kind == 'tracemalloc':
+            result.data.dump(path)
+        else:
+            with open(path, 'wb') as f:
+                if result.kind == 'cprofile':
+                    marshal.dump(result.data, f)
+                else:
+                    for stack, count in sorted(result.data.items()):
+                        f.write(("%s %d\n" % (stack, count)).encode('utf-8'))
+
+        self.logger.info("Saved profile of plugin %s to %s", plugin, path)
+
+    def _forget_call(self, call_id):
+        """Stops waiting for a response to a call which is done"""
+        with self.call_lock:
+            self.calls.pop(call_id, None)
+
+    def _expire_calls(self):
+        """Fails calls past their deadline
+
+        Deadlines of calls which completed in time are left in the heap, and
+        skipped once they pass.
+        """
+        now = _monotonic()
+        futures = []
+
+        with self.call_lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, call_id = heapq.heappop(self._deadlines)
+
+                future = self.calls.pop(call_id, None)
+                if future is not None:
+                    futures.append(future)
+
+        for future in futures:
+            future._resolve(exception=PluginError(
+                "Call to %s() timed out" % future.method, future.plugin))
+
+    def _fail_calls(self, plugin, reason):
+        """Fails all calls awaiting a response from a plugin
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin whose calls should fail
+        reason : str
+            Error message to fail the calls with
+        """
+        with self.call_lock:
+            failed = [
+                call_id for call_id, future in self.calls.items()
+                if future.plugin == plugin
+            ]
+            futures = [self.calls.pop(call_id) for call_id in failed]
+
+        for future in futures:
+            future._resolve(exception=PluginError(reason, plugin))
+
+    def _start_reaping_thread(self):
+        self.reap_timer = threading.Timer(5, self.reap_plugins)
+        self.reap_timer.start()
+
+    def _stop_reaping_thread(self):
+        self.reap_timer.cancel()
+        self.reap_timer.join()
+
+    @abstractmethod
+    def _stop_plugin(self, plugin):
+        """This method must be overridden to send a clean shutdown signal.
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin to stop
+        """
+
+    def _process_message(self, plugin, message):
+        """This method should be overridden by subclasses.
+
+        Processes a message from a plugin.
+
+        Parameters
+        ----------
+        plugin : str
+            The name of the plugin that sent the message
         message
             Could be any pickle-able object sent from the plugin
         """
         raise NotImplementedError(
             "Subclasses should implement _process_message()")
+
+
+class PluginAgent(object):
+    """Runs plugins on behalf of a :any:`RemotePluginManager` on another host
+
+    The agent listens on a socket, accepting connections authenticated with
+    `authkey`. Each connection is served by its own thread, and may start and
+    stop plugins, send them events, and poll for their messages.
+    """
+
+    plugin_runner = PluginRunner
+    """PluginRunner class to run plugins.
+
+    This should be overridden with the same runner the manager would use to
+    run plugins locally.
+    """
+
+    def __init__(self, address, authkey):
+        """Accepts the address to listen on and the authentication key.
+
+        Parameters
+        ----------
+        address : tuple
+            (host, port) tuple to listen on.
+        authkey : bytes
+            Key managers must authenticate with.
+        """
+        self.address = address
+        self.authkey = authkey
+
+        self.listener = None
+        self.plugins = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        """Starts listening for connections
+
+        Afterwards, `address` is the address actually listened on, including
+        the port picked by the OS if port 0 was given.
+        """
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address
+
+        self.logger.info("Agent listening on %s:%s", *self.address)
+
+    def serve_forever(self):
+        """Accepts connections from managers until :any:`close()` is called
+
+        Starts listening first, unless :any:`start()` was already called.
+        """
+        if self.listener is None:
+            self.start()
+
+        listener = self.listener
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (IOError, EOFError,
+                        multiprocessing.AuthenticationError):
+                    if self.listener is None:
+                        break
+
+                    self.logger.exception("Unable to accept connection")
+                    continue
+
+                if self.listener is None:
+                    conn.close()
+                    break
+
+                thread = threading.Thread(target=self._serve, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+
+    def close(self):
+        """Stops accepting connections, and terminates all plugins"""
+        if self.listener is None:
+            return
+
+        self.listener = None
+
+        # Wake up serve_forever() so that it notices
+        try:
+            socket.create_connection(self.address).close()
+        except (IOError, OSError):
+            pass
+
+        with self.lock:
+            plugins, self.plugins = self.plugins, {}
+
+        for plugin in plugins.values():
+            plugin['process'].terminate()
+            plugin['process'].join()
+
+    def _serve(self, conn):
+        """Handles requests from a connection until it's closed
+
+        Each request is a tuple of a batch of `(plugin, event)` tuples to
+        deliver, followed by a command and its arguments. The response is a
+        tuple of whether the command succeeded, and its return value or error.
+        """
+        try:
+            while True:
+                events, command, args = conn.recv()
+
+                try:
+                    response = (True, self._handle(events, command, args))
+                except Exception as e:
+                    self.logger.exception("Error handling %s", command)
+                    response = (False, str(e))
+
+                conn.send(response)
+        except (IOError, EOFError):
+            self.logger.debug("Connection closed")
+        finally:
+            conn.close()
+
+    def _handle(self, events, command, args):
+        """Delivers a batch of events, then runs a command
+
+        Returns
+        -------
+            The return value of the command.
+        """
+        with self.lock:
+            for name, event in events:
+                if name in self.plugins:
+                    self.plugins[name]['events'].put(event)
+
+        return getattr(self, '_command_%s' % command)(*args)
+
+    def _command_ping(self):
+        """Does nothing, used to flush events"""
+
+    def _command_start(self, name, resources=None, shared_data=None):
+        with self.lock:
+            if name in self.plugins and \
+                    self.plugins[name]['process'].is_alive():
+                raise PluginError("Plugin is already running", name)
+
+            events = multiprocessing.Queue()
+            messages = multiprocessing.Queue()
+            process = self.plugin_runner(
+                name, events, messages, resources=resources,
+                shared_data=shared_data)
+            process.start()
+
+            self.plugins[name] = {
+                'events': events,
+                'messages': messages,
+                'process': process,
+            }
+
+        self.logger.info("Started plugin %s", name)
+
+    def _command_join(self, name, timeout):
+        with self.lock:
+            plugin = self.plugins.get(name)
+
+        if plugin is not None:
+            plugin['process'].join(timeout)
+
+            return plugin['process'].exitcode
+
+    def _command_terminate(self, name):
+        with self.lock:
+            plugin = self.plugins.get(name)
+
+        if plugin is not None:
+            plugin['process'].terminate()
+
+    def _command_poll(self):
+        """Collects queued messages and the status of every plugin
+
+        Plugins which have terminated are forgotten once their remaining
+        messages have been collected.
+
+        Returns
+        -------
+        dict
+            Maps plugin names to a tuple of the process exit code (None while
+            the plugin is running), and a list of its messages.
+        """
+        status = {}
+
+        with self.lock:
+            for name, plugin in list(self.plugins.items()):
+                exitcode = plugin['process'].exitcode
+
+                messages = []
+                while not plugin['messages'].empty():
+                    messages.append(plugin['messages'].get())
+
+                status[name] = (exitcode, messages)
+
+                if exitcode is not None:
+                    del self.plugins[name]
+
+        return status
+
+
+class RemoteHost(object):
+    """Pool of connections to a :any:`PluginAgent`
+
+    Events are batched, and sent along with the next request to the agent, or
+    once `batch_size` events are waiting. Requests which couldn't be sent are
+    retried on a new connection. Only :any:`idempotent_commands` are retried
+    if the connection drops while the agent is responding, in which case
+    their events may be delivered more than once.
+    """
+
+    idempotent_commands = ('ping', 'poll', 'join')
+    """Commands which may safely be sent again if the agent doesn't respond"""
+
+    def __init__(self, address, authkey, batch_size=1, retries=3):
+        """Accepts the agent's address and authentication key.
+
+        Parameters
+        ----------
+        address : tuple
+            (host, port) tuple the agent listens on.
+        authkey : bytes
+            Key to authenticate with the agent.
+        batch_size : int
+            Number of events to buffer before sending them to the agent.
+        retries : int
+            Number of times to reconnect before a request fails.
+        """
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.retries = retries
+
+        self.pool = []
+        self.pending = []
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def put_event(self, name, event):
+        """Queues an event for a plugin, sending it once the batch is full"""
+        with self.lock:
+            self.pending.append((name, event))
+            full = len(self.pending) >= self.batch_size
+
+        if full:
+            self.request('ping')
+
+    def request(self, command, *args):
+        """Sends pending events and a command to the agent
+
+        Returns
+        -------
+            The return value of the command.
+
+        Raises
+        ------
+        PluginError
+            If the agent can't be reached, or the command failed.
+        """
+        with self.lock:
+            events, self.pending = self.pending, []
+
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self._acquire()
+            except (IOError, OSError):
+                self.logger.warning("Unable to connect to agent %s:%s",
+                                    *self.address)
+                continue
+
+            try:
+                conn.send((events, command, args))
+            except (IOError, OSError):
+                conn.close()
+                self.logger.warning("Lost connection to agent %s:%s",
+                                    *self.address)
+                continue
+
+            try:
+                success, value = conn.recv()
+            except (IOError, EOFError, OSError):
+                conn.close()
+
+                # The agent may already have run the command
+                if command not in self.idempotent_commands:
+                    raise PluginError(
+                        "Lost connection to agent %s:%s during %s" %
+                        (self.address + (command,)),
+                        args[0] if args else None)
+
+                self.logger.warning("Lost connection to agent %s:%s",
+                                    *self.address)
+                continue
+
+            self._release(conn)
+
+            if not success:
+                raise PluginError(value, args[0] if args else None)
+
+            return value
+
+        # Keep the events to send with the next request
+        with self.lock:
+            self.pending[:0] = events
+
+        raise PluginError("Unable to reach agent %s:%s" % self.address, None)
+
+    def close(self):
+        """Closes all pooled connections"""
+        with self.lock:
+            pool, self.pool = self.pool, []
+
+        for conn in pool:
+            conn.close()
+
+    def _acquire(self):
+        """Takes a connection from the pool, or opens a new one"""
+        with self.lock:
+            if self.pool:
+                return self.pool.pop()
+
+        return Client(self.address, authkey=self.authkey)
+
+    def _release(self, conn):
+        """Returns a connection to the pool"""
+        with self.lock:
+            self.pool.append(conn)
+
+
+class RemoteEventQueue(object):
+    """Stand-in for a plugin's event queue on a :any:`PluginAgent`"""
+
+    def __init__(self, host, name):
+        self.host = host
+        self.name = name
+
+    def put(self, event, block=True, timeout=None):
+        self.host.put_event(self.name, event)
+
+
+class RemoteProcess(object):
+    """Stand-in for a plugin's process on a :any:`PluginAgent`
+
+    The process status is refreshed when :any:`RemotePluginManager` polls the
+    agent, rather than on every call to :any:`is_alive()`.
+
+    Attributes
+    ----------
+    exitcode : int
+        The exit code of the process, or None if it hasn't terminated.
+    """
+
+    def __init__(self, host, name, resources=None, shared_data=None):
+        self.host = host
+        self.name = name
+        self.resources = resources
+        self.shared_data = shared_data
+
+        self.exitcode = None
+        self.started = False
+
+    def start(self):
+        self.host.request('start', self.name, self.resources,
+                          self.shared_data)
+        self.started = True
+
+    def is_alive(self):
+        return self.started and self.exitcode is None
+
+    def join(self, timeout=None):
+        exitcode = self.host.request('join', self.name, timeout)
+        if exitcode is not None:
+            self.exitcode = exitcode
+
+    def terminate(self):
+        self.host.request('terminate', self.name)
+
+
+class RemotePluginManager(PluginManager):
+    """Runs plugins on :any:`PluginAgent` processes instead of locally
+
+    Plugins are started on the agent running the fewest of this manager's
+    plugins. Each call to :any:`reap_plugins()` polls every agent once for
+    the status and messages of all of its plugins. Plugins on an agent which
+    can't be reached keep their last known status, until `max_failed_polls`
+    polls in a row have failed.
+
+    Only files can be shared with :any:`share_data()`, and they must exist at
+    the same path on the agent's host.
+    """
+
+    def __init__(self, hosts, batch_size=1, retries=3, max_failed_polls=3):
+        """Accepts the agents to run plugins on.
+
+        Parameters
+        ----------
+        hosts : list
+            List of (address, authkey) tuples for each agent.
+        batch_size : int
+            Number of events to buffer before sending them to an agent.
+        retries : int
+            Number of times to reconnect before a request fails.
+        max_failed_polls : int
+            Number of polls in a row which may fail before an agent's plugins
+            are considered lost.
+        """
+        super(RemotePluginManager, self).__init__()
+
+        self.hosts = [
+            RemoteHost(address, authkey, batch_size, retries)
+            for address, authkey in hosts
+        ]
+        self.max_failed_polls = max_failed_polls
+
+        # Number of polls in a row that failed, mapped by host
+        self.failed_polls = dict((id(host), 0) for host in self.hosts)
+
+    def __exit__(self, type, value, traceback):
+        super(RemotePluginManager, self).__exit__(type, value, traceback)
+
+        for host in self.hosts:
+            host.close()
+
+    def reap_plugins(self):
+        """Polls agents for messages, then reaps plugins that terminated"""
+        with self.reap_lock:
+            for host in self.hosts:
+                self._poll_host(host)
+
+            super(RemotePluginManager, self).reap_plugins()
+
+    def _create_plugin(self, name, resources=None):
+        load = dict((id(host), 0) for host in self.hosts)
+        for plugin in self.plugins.values():
+            load[id(plugin['host'])] += 1
+
+        host = min(self.hosts, key=lambda host: load[id(host)])
+
+        # Shared memory is local to this host, but files may be shared if
+        # they're present at the same path on the agent's host
+        shared_data = dict(
+            (key, value) for key, value in self.shared_data.items()
+            if value[0] == 'file'
+        )
+
+        return {
+            'host': host,
+            'events': RemoteEventQueue(host, name),
+            'messages': queue.Queue(),
+            'process': RemoteProcess(host, name, resources, shared_data),
+        }
+
+    def _poll_host(self, host):
+        """Collects messages and status of the plugins running on an agent
+
+        Parameters
+        ----------
+        host : RemoteHost
+            The agent to poll
+        """
+        plugins = dict(
+            (name, plugin) for name, plugin in self.plugins.items()
+            if plugin['host'] is host
+        )
+        if not plugins:
+            return
+
+        try:
+            status = host.request('poll')
+        except PluginError:
+            self.failed_polls[id(host)] += 1
+            if self.failed_polls[id(host)] < self.max_failed_polls:
+                self.logger.warning("Unable to poll agent %s:%s, will retry",
+                                    *host.address)
+                return
+
+            self.logger.exception("Unable to poll agent %s:%s, its plugins "
+                                  "are lost", *host.address)
+            status = {}
+        else:
+            self.failed_polls[id(host)] = 0
+
+        for name, plugin in plugins.items():
+            # Plugins the agent doesn't know about are lost
+            exitcode, messages = status.get(name, (-1, []))
+
+            for message in messages:
+                plugin['messages'].put(message)
+
+            plugin['process'].exitcode = exitcode
@@ -0,0 +1,413 @@
+"""Benchmarks for the pplugins hot paths
+
+Measures event round-trip latency, throughput by payload size, plugin start
+and stop latency, the time taken by each phase of starting a plugin, and the
+cost of managing a growing number of plugins. The results can be written as
+JSON, and compared against a previous run::
+
+    python -m pplugins_bench --output baseline.json
+    python -m pplugins_bench --baseline baseline.json
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib
+
+import pplugins
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    timer = time.perf_counter
+except AttributeError:  # Python 2
+    timer = time.time
+
+# File descriptors the manager holds open for each running plugin
+FILES_PER_PLUGIN = 6
+
+
+class EchoPlugin(pplugins.Plugin):
+    """Sends every event back to the manager"""
+
+    def run(self):
+        while True:
+            event = self.interface.events.get()
+
+            if self.handle_control(event):
+                continue
+
+            if event is None:
+                break
+
+            self.interface.messages.put(event)
+
+    @pplugins.expose
+    def echo(self, value):
+        return value
+
+
+class BenchPluginRunner(pplugins.PluginRunner):
+    """Runs :any:`EchoPlugin`"""
+
+    def _load_plugin(self):
+        return importlib.import_module('pplugins_bench')
+
+
+class BenchPluginManager(pplugins.PluginManager):
+    """Counts the messages received from plugins"""
+
+    plugin_runner = BenchPluginRunner
+
+    def __init__(self, *args, **kwargs):
+        super(BenchPluginManager, self).__init__(*args, **kwargs)
+
+        self.received = 0
+
+    def _stop_plugin(self, name):
+        self.plugins[name]['events'].put(None)
+        self.plugins[name]['process'].join(10)
+
+    def _process_message(self, plugin, message):
+        self.received += 1
+
+    def wait_for_messages(self, count, timeout=30):
+        """Processes messages until `count` have been received in total
+
+        Raises
+        ------
+        PluginError
+            If they aren't received within `timeout` seconds.
+        """
+        deadline = timer() + timeout
+        while self.received < count:
+            if timer() > deadline:
+                raise pplugins.PluginError(
+                    "Timed out waiting for %d messages" % count, None)
+
+            self.process_messages()
+
+    def wait_for_startup(self, name, timeout=30):
+        """Processes messages until a plugin has reported its startup
+
+        Raises
+        ------
+        PluginError
+            If the plugin exits, or doesn't report within `timeout` seconds.
+        """
+        deadline = timer() + timeout
+        while 'startup' not in self.plugins[name]:
+            if not self.plugins[name]['process'].is_alive():
+                raise pplugins.PluginError("Plugin exited", name)
+
+            if timer() > deadline:
+                raise pplugins.PluginError("Plugin didn't start", name)
+
+            self.process_messages()
+
+
+def percentile(samples, percent):
+    """Returns the given percentile of a list of samples
+
+    Parameters
+    ----------
+    samples : list
+        Samples to take the percentile of.
+    percent : float
+        Percentile between 0 and 100.
+    """
+    samples = sorted(samples)
+    index = int(round(percent / 100.0 * (len(samples) - 1)))
+
+    return samples[index]
+
+
+def bench_round_trip(manager, samples):
+    """Measures the time for an event to be echoed back, in microseconds"""
+    manager.start_plugin('echo')
+    events = manager.plugins['echo']['events']
+
+    latencies = []
+    for i in range(samples):
+        start = timer()
+        events.put(i)
+        manager.wait_for_messages(manager.received + 1)
+        latencies.append((timer() - start) * 1e6)
+
+    manager.stop_plugin('echo')
+
+    return {
+        'round_trip_p50_us': percentile(latencies, 50),
+        'round_trip_p99_us': percentile(latencies, 99),
+    }
+
+
+def bench_throughput(manager, payload_sizes, total_bytes):
+    """Measures sustained events per second through a plugin and back"""
+    manager.start_plugin('echo')
+    events = manager.plugins['echo']['events']
+
+    results = {}
+    for size in payload_sizes:
+        payload = b'x' * size
+        count = max(100, min(10000, total_bytes // size))
+
+        start = timer()
+        expected = manager.received + count
+        for _ in range(count):
+            events.put(payload)
+        manager.wait_for_messages(expected)
+        elapsed = timer() - start
+
+        results['throughput_%db_per_sec' % size] = count / elapsed
+
+    manager.stop_plugin('echo')
+
+    return results
+
+
+def bench_lifecycle(manager, samples):
+    """Measures start_plugin() and stop_plugin() latency, in milliseconds"""
+    starts, stops = [], []
+    for _ in range(samples):
+        start = timer()
+        manager.start_plugin('echo')
+        starts.append((timer() - start) * 1e3)
+
+        start = timer()
+        manager.stop_plugin('echo')
+        stops.append((timer() - start) * 1e3)
+
+    return {
+        'start_plugin_p50_ms': percentile(starts, 50),
+        'start_plugin_p99_ms': percentile(starts, 99),
+        'stop_plugin_p50_ms': percentile(stops, 50),
+        'stop_plugin_p99_ms': percentile(stops, 99),
+    }
+
+
+def bench_startup(manager, samples):
+    """Measures each phase of starting a plugin, in milliseconds"""
+    phases = {}
+    for _ in range(samples):
+        manager.start_plugin('echo')
+        manager.wait_for_startup('echo')
+
+        for phase, duration in manager.plugins['echo']['startup'].items():
+            phases.setdefault(phase, []).append(duration * 1e3)
+
+        manager.stop_plugin('echo')
+
+    return dict(
+        ('startup_%s_p50_ms' % phase, percentile(durations, 50))
+        for phase, durations in phases.items()
+    )
+
+
+def bench_scaling(manager, plugin_counts, samples):
+    """Measures the cost of managing plugins as their number grows
+
+    Process and reap times are in microseconds, and memory per plugin is the
+    mean unique set size (USS) of the plugin processes, in bytes.
+    """
+    results = {}
+    limit = max_plugins()
+    try:
+        for count in plugin_counts:
+            if limit is not None and count > limit:
+                sys.stderr.write("Skipping %d plugins, only %d fit in the "
+                                 "open file limit\n" % (count, limit))
+                continue
+
+            names = ['echo-%d' % i
+                     for i in range(len(manager.plugins), count)]
+            for name in names:
+                manager.start_plugin(name)
+
+            # Measure plugins once they're running
+            for name in names:
+                manager.wait_for_startup(name)
+
+            start = timer()
+            for _ in range(samples):
+                manager.process_messages()
+            results['process_messages_%d_plugins_us' % count] = \
+                (timer() - start) / samples * 1e6
+
+            start = timer()
+            for _ in range(samples):
+                manager.reap_plugins()
+            results['reap_plugins_%d_plugins_us' % count] = \
+                (timer() - start) / samples * 1e6
+
+            usage = [manager.memory_usage(name) for name in manager.plugins]
+            if None not in usage:
+                results['uss_per_plugin_%d_plugins_bytes' % count] = \
+                    sum(u['uss'] for u in usage) / float(len(usage))
+    finally:
+        for name in list(manager.plugins):
+            manager.stop_plugin(name)
+
+    return results
+
+
+def raise_file_limit():
+    """Raises the soft limit on open files as far as the hard limit allows"""
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == hard:
+        return
+
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):  # e.g. an unlimited hard limit on macOS
+        pass
+
+
+def max_plugins():
+    """Returns how many plugins fit in the open file limit, or None"""
+    if resource is None:
+        return None
+
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return None
+
+    # Leave room for the files the benchmark itself opens
+    return (soft - 64) // FILES_PER_PLUGIN
+
+
+def compare(results, baseline, tolerance):
+    """Returns the metrics that regressed compared to a baseline
+
+    Throughput metrics regress when they decrease, and all other metrics
+    regress when they increase, by more than `tolerance`.
+
+    Parameters
+    ----------
+    results : dict
+        Metrics of this run.
+    baseline : dict
+        Metrics of the run to compare against.
+    tolerance : float
+        Fraction by which a metric may get worse.
+
+    Returns
+    -------
+    list
+        Tuples of the metric name, baseline value, and value.
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        if name.endswith('_per_sec'):
+            regressed = value < baseline[name] * (1 - tolerance)
+        else:
+            regressed = value > baseline[name] * (1 + tolerance)
+
+        if regressed:
+            regressions.append((name, baseline[name], value))
+
+    return regressions
+
+
+def run(args):
+    """Runs the benchmarks, returning a dictionary of metrics"""
+    results = {}
+
+    preload = ['pplugins_bench'] if args.start_method == 'forkserver' else None
+    manager = BenchPluginManager(args.start_method, preload)
+    manager.freeze_gc = args.freeze_gc
+
+    raise_file_limit()
+
+    try:
+        results.update(bench_round_trip(manager, args.samples))
+        results.update(bench_throughput(manager, args.payload_sizes,
+                                        args.total_bytes))
+        results.update(bench_lifecycle(manager, max(1, args.samples // 100)))
+        results.update(bench_startup(manager, max(1, args.samples // 100)))
+        results.update(bench_scaling(manager, args.plugin_counts,
+                                     max(1, args.samples // 100)))
+    finally:
+        # Don't leave plugins running if a benchmark failed
+        for name in list(manager.plugins):
+            manager.stop_plugin(name)
+
+    return results
+
+
+def parse_args(argv):
+    def int_list(value):
+        return [int(i) for i in value.split(',')]
+
+    parser = argparse.ArgumentParser(
+        prog='python -m pplugins_bench', description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline',
+                        help="compare results against this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="fraction a metric may regress by "
+                             "(default: %(default)s)")
+    parser.add_argument('--samples', type=int, default=1000,
+                        help="round trips to time (default: %(default)s)")
+    parser.add_argument('--payload-sizes', type=int_list,
+                        default=[64, 1024, 16384, 262144],
+                        help="comma-separated payload sizes in bytes "
+                             "(default: 64,1024,16384,262144)")
+    parser.add_argument('--total-bytes', type=int, default=64 * 1024 * 1024,
+                        help="bytes to send per payload size "
+                             "(default: %(default)s)")
+    parser.add_argument('--plugin-counts', type=int_list,
+                        default=[1, 10, 100, 500],
+                        help="comma-separated plugin counts "
+                             "(default: 1,10,100,500)")
+    parser.add_argument('--start-method',
+                        choices=['fork', 'spawn', 'forkserver'],
+                        help="start method for plugin processes "
+                             "(default: the platform default)")
+    parser.add_argument('--freeze-gc', action='store_true',
+                        help="freeze the garbage collector before forking")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+
+    for name, value in sorted(results.items()):
+        print("%-45s %15.1f" % (name, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print("Regression in %s: %.1f -> %.1f" % (name, before, after))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
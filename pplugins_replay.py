@@ -0,0 +1,215 @@
+"""Replays recorded traffic against a plugin
+
+Feeds the events a plugin was sent in a recording made with
+:any:`PluginManager.start_recording()` to a fresh plugin process, at the
+recorded pace, a multiple of it, or as fast as possible, and reports how well
+the plugin kept up::
+
+    python -m pplugins_replay traffic.log myapp:MyRunner example --speed 2
+"""
+import sys
+import bisect
+import argparse
+import importlib
+import multiprocessing
+
+from six.moves import queue
+
+import pplugins
+from pplugins_bench import percentile, timer
+
+# Messages sent by the framework rather than the plugin's application code
+FRAMEWORK_MESSAGES = (pplugins.StartupReport, pplugins.CallResponse,
+                      pplugins.ProfileResult)
+
+
+def load_events(path, source):
+    """Reads the events sent to a plugin in a recording
+
+    Each event is paired with the number of messages the plugin had sent when
+    it was recorded, so that responses can be matched to the event that
+    triggered them. Messages sent by the framework aren't counted.
+
+    Parameters
+    ----------
+    path : str
+        Path to the recording.
+    source : str
+        Name of the recorded plugin.
+
+    Returns
+    -------
+    tuple
+        Tuple of a list of (timestamp, messages sent, event) tuples, and the
+        number of messages the plugin sent.
+    """
+    events = []
+    messages = 0
+    for timestamp, direction, plugin, obj in pplugins.read_recording(path):
+        if plugin != source:
+            continue
+
+        if direction == pplugins.TrafficRecorder.EVENT:
+            events.append((timestamp, messages, obj))
+        elif not isinstance(obj, FRAMEWORK_MESSAGES):
+            messages += 1
+
+    return events, messages
+
+
+def backlog(events):
+    """Returns the number of events waiting in a queue, or None if unknown"""
+    try:
+        return events.qsize()
+    except NotImplementedError:  # macOS
+        return None
+
+
+def replay(runner, plugin, events, expected_messages, speed=1.0, drain=5.0):
+    """Feeds recorded events to a new plugin process
+
+    Parameters
+    ----------
+    runner : class
+        PluginRunner subclass to run the plugin with.
+    plugin : str
+        Plugin name to run.
+    events : list
+        Recorded events returned by :any:`load_events()`.
+    expected_messages : int
+        Number of messages the plugin sent in the recording.
+    speed : float
+        Multiple of the recorded pace to send events at, or 0 to send them as
+        fast as possible.
+    drain : float
+        Seconds to wait for outstanding messages once all events are sent.
+
+    Returns
+    -------
+    dict
+        Replay statistics.
+    """
+    event_queue = multiprocessing.Queue()
+    message_queue = multiprocessing.Queue()
+    process = runner(plugin, event_queue, message_queue)
+    process.start()
+
+    # Messages sent by the plugin before each event was recorded
+    recorded = [messages for _, messages, _ in events]
+
+    sent_at = []
+    received_at = []
+    latencies = []
+    max_backlog = None
+
+    def receive(timeout=0):
+        try:
+            if timeout:
+                message = message_queue.get(timeout=timeout)
+            else:
+                message = message_queue.get_nowait()
+        except queue.Empty:
+            return False
+
+        # Only responses to events are matched to them
+        if isinstance(message, FRAMEWORK_MESSAGES):
+            return True
+
+        received_at.append(timer())
+
+        # Match the message to the last event sent before it was recorded
+        trigger = min(bisect.bisect_right(recorded, len(latencies)),
+                      len(sent_at)) - 1
+        if trigger >= 0:
+            latencies.append(received_at[-1] - sent_at[trigger])
+        else:
+            latencies.append(None)
+
+        return True
+
+    start = timer()
+    first = events[0][0] if events else 0
+    for timestamp, _, event in events:
+        if speed:
+            due = start + (timestamp - first) / speed
+            while timer() < due:
+                receive(due - timer())
+
+        event_queue.put(event)
+        sent_at.append(timer())
+
+        while receive():
+            pass
+
+        size = backlog(event_queue)
+        if size is not None:
+            max_backlog = max(max_backlog or 0, size)
+
+    # Wait for the plugin to consume its backlog and respond
+    consumed = None
+    deadline = timer() + drain
+    while timer() < deadline and (consumed is None or
+                                  len(latencies) < expected_messages):
+        if consumed is None and backlog(event_queue) == 0:
+            consumed = timer()
+
+        receive(0.01)
+
+    process.terminate()
+    process.join()
+
+    # Without a queue size, assume events were consumed by the last response
+    if consumed is None:
+        consumed = received_at[-1] if received_at else timer()
+
+    elapsed = consumed - start
+    matched = [latency * 1e3 for latency in latencies if latency is not None]
+
+    return {
+        'events': len(events),
+        'messages': len(latencies),
+        'expected_messages': expected_messages,
+        'events_per_sec': len(events) / elapsed if elapsed > 0 else None,
+        'max_backlog': max_backlog,
+        'latency_p50_ms': percentile(matched, 50) if matched else None,
+        'latency_p99_ms': percentile(matched, 99) if matched else None,
+    }
+
+
+def load_runner(name):
+    """Imports a PluginRunner subclass given as module:class"""
+    module, _, cls = name.partition(':')
+
+    return getattr(importlib.import_module(module), cls)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pplugins_replay', description=__doc__.split('\n')[0])
+    parser.add_argument('recording', help="recording to replay")
+    parser.add_argument('runner',
+                        help="PluginRunner subclass, as module:class")
+    parser.add_argument('plugin', help="plugin name to run")
+    parser.add_argument('--source',
+                        help="recorded plugin name, if different from plugin")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="multiple of the recorded pace, or 0 for as fast "
+                             "as possible (default: %(default)s)")
+    parser.add_argument('--drain', type=float, default=5.0,
+                        help="seconds to wait for outstanding messages "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    events, expected = load_events(args.recording,
+                                   args.source or args.plugin)
+    stats = replay(load_runner(args.runner), args.plugin, events, expected,
+                   args.speed, args.drain)
+
+    for name, value in sorted(stats.items()):
+        print("%-20s %s" % (name, value))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
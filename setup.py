@@ -1,7 +1,7 @@
 from setuptools import setup
 setup(
     name='pplugins',
-    py_modules=['pplugins'],
+    py_modules=['pplugins', 'pplugins_bench', 'pplugins_replay'],
     install_requires=['six>=1.10.0'],
 
     author='John Maguire',
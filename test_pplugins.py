@@ -1,3 +1,7 @@
+import os
+import time
+import errno
+import signal
 import multiprocessing
 import threading
 
@@ -6,6 +10,7 @@ from mock import patch
 import pytest
 
 import pplugins
+import pplugins_bench
 
 DEFAULT = "default"
 
@@ -90,6 +95,124 @@ def test_pluginrunner_run():
     load_plugin_mock.assert_called_once_with()
 
 
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+def test_pluginrunner_run_custom_interface():
+    # interfaces that don't extend PluginInterface only get the queues
+    class InterfaceStub(object):
+        def __init__(self, event_queue, message_queue):
+            self.events = event_queue
+            self.messages = message_queue
+
+    class PluginStub(pplugins.Plugin):
+        def run(self):
+            assert isinstance(self.interface, InterfaceStub)
+            raise MemoryError
+
+    class PluginRunnerStub(pplugins.PluginRunner):
+        interface = InterfaceStub
+
+    pr = PluginRunnerStub(None, 'events', 'messages', shared_data={})
+    module = type('Module', (), {'PluginStub': PluginStub})
+
+    with patch.object(pplugins.PluginRunner, '_load_plugin',
+                      return_value=module), \
+            pytest.raises(SystemExit):
+        pr.run()
+
+    # subclasses taking only the queues are given shared data afterwards
+    class PluginInterfaceStub(pplugins.PluginInterface):
+        def __init__(self, event_queue, message_queue):
+            super(PluginInterfaceStub, self).__init__(event_queue,
+                                                      message_queue)
+
+    class SharedDataPluginStub(pplugins.Plugin):
+        def run(self):
+            assert self.interface.shared_data == {'data': ('file', 'path')}
+            raise MemoryError
+
+    PluginRunnerStub.interface = PluginInterfaceStub
+    pr = PluginRunnerStub(None, 'events', queue.Queue(),
+                          shared_data={'data': ('file', 'path')})
+    module = type('Module', (), {'SharedDataPluginStub': SharedDataPluginStub})
+
+    with patch.object(pplugins.PluginRunner, '_load_plugin',
+                      return_value=module), \
+            pytest.raises(SystemExit):
+        pr.run()
+
+
+@patch.multiple(pplugins.Plugin, __abstractmethods__=set())
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+def test_pluginrunner_run_resources():
+    resources = pplugins.PluginResources(cpus={0})
+    pr = pplugins.PluginRunner(None, None, None, resources=resources)
+
+    class MemoryErrorPluginStub(pplugins.Plugin):
+        def __init__(self, _):
+            raise MemoryError
+
+    module = type('Module', (),
+                  {'MemoryErrorPluginStub': MemoryErrorPluginStub})
+
+    # resources are applied, and running out of memory exits the process
+    with patch.object(pplugins.PluginRunner, '_load_plugin',
+                      return_value=module), \
+        patch.object(pplugins.PluginResources, 'apply') as apply_mock, \
+            pytest.raises(SystemExit) as excinfo:
+        pr.run()
+
+    apply_mock.assert_called_once_with()
+    assert excinfo.value.code == pplugins.RESOURCE_LIMIT_EXIT_CODE
+
+    # so does running out of file descriptors while importing the plugin
+    error = OSError(errno.EMFILE, "Too many open files")
+    with patch.object(pplugins.PluginRunner, '_load_plugin',
+                      side_effect=error), \
+        patch.object(pplugins.PluginResources, 'apply'), \
+            pytest.raises(SystemExit) as excinfo:
+        pr.run()
+
+    assert excinfo.value.code == pplugins.RESOURCE_LIMIT_EXIT_CODE
+
+
+def test_pluginresources_apply(tmpdir):
+    resources = pplugins.PluginResources(
+        cpus={0, 1}, nice=5, scheduler=(3, 0), rlimits={7: 64, 9: (1, 2)},
+        cgroup=str(tmpdir))
+
+    with patch('os.sched_setaffinity', create=True) as affinity_mock, \
+        patch('os.nice') as nice_mock, \
+        patch('os.sched_setscheduler', create=True) as scheduler_mock, \
+        patch('os.sched_param', create=True, return_value='param'), \
+            patch.object(pplugins, 'resource') as resource_mock:
+        resources.apply()
+
+    assert tmpdir.join('cgroup.procs').read() == str(os.getpid())
+    affinity_mock.assert_called_once_with(0, {0, 1})
+    nice_mock.assert_called_once_with(5)
+    scheduler_mock.assert_called_once_with(0, 3, 'param')
+    resource_mock.setrlimit.assert_any_call(7, (64, 64))
+    resource_mock.setrlimit.assert_any_call(9, (1, 2))
+
+    # a CPU limit leaves time for SIGXCPU before SIGKILL
+    resources = pplugins.PluginResources(rlimits={0: 10, 1: 10})
+    with patch.object(pplugins, 'resource') as resource_mock:
+        resource_mock.RLIMIT_CPU = 0
+        resource_mock.getrlimit.return_value = (20, 20)
+        resources.apply()
+
+    resource_mock.setrlimit.assert_any_call(0, (10, 11))
+    resource_mock.setrlimit.assert_any_call(1, (10, 10))
+
+    # nothing is restricted by default
+    with patch('os.nice') as nice_mock, \
+            patch.object(pplugins, 'resource') as resource_mock:
+        pplugins.PluginResources().apply()
+
+    nice_mock.assert_not_called()
+    resource_mock.setrlimit.assert_not_called()
+
+
 def test_pluginmanager_abstract():
     with pytest.raises(TypeError):
         pplugins.PluginManager()
@@ -140,7 +263,7 @@ def test_pluginmanager_start_plugin(_, __):
 
     # test error starting a plugin
     class PluginRunnerErrorStub(pplugins.PluginRunner):
-        def __init__(self, _, __, ___):
+        def __init__(self, _, __, ___, **kwargs):
             raise Exception
 
     pm.plugin_runner = PluginRunnerErrorStub
@@ -227,3 +350,783 @@ def test_pluginmanager_reap_plugins():
         pm.reap_plugins()
 
     assert pm.plugins == plugins
+
+    # resource limit violations are told apart
+    assert pm._exceeded_resources(pplugins.RESOURCE_LIMIT_EXIT_CODE)
+    assert pm._exceeded_resources(-signal.SIGXCPU)
+    assert not pm._exceeded_resources(1)
+    assert not pm._exceeded_resources(-signal.SIGTERM)
+
+    pm.plugins = plugins
+    with patch.object(multiprocessing.Process, 'is_alive',
+                      return_value=False), \
+        patch.object(multiprocessing.Process, 'exitcode',
+                     pplugins.RESOURCE_LIMIT_EXIT_CODE), \
+            patch.object(pm.logger, 'warning') as warning_mock:
+        pm.reap_plugins()
+
+    assert 'resource limit' in warning_mock.call_args[0][0] % \
+        warning_mock.call_args[0][1:]
+
+
+def test_callfuture():
+    future = pplugins.CallFuture('test', 'method')
+    assert not future.done()
+
+    # waiting times out while unresolved
+    with pytest.raises(pplugins.PluginError) as excinfo:
+        future.result(0)
+
+    assert 'Timed out' in str(excinfo.value)
+
+    # callbacks are called once resolved, or immediately if already done
+    callbacks = []
+    future.add_done_callback(callbacks.append)
+    assert future._resolve(result='result') is True
+    future.add_done_callback(callbacks.append)
+    assert callbacks == [future, future]
+    assert future.result() == 'result'
+    assert future.exception() is None
+
+    # can't be resolved or cancelled twice
+    assert future._resolve(result='other') is False
+    assert future.cancel() is False
+    assert future.result() == 'result'
+
+    # cancelled
+    future = pplugins.CallFuture('test', 'method')
+    assert future.cancel() is True
+    assert future.cancelled() is True
+    with pytest.raises(pplugins.PluginError) as excinfo:
+        future.result()
+
+    assert 'cancelled' in str(excinfo.value)
+
+
+@patch.multiple(pplugins.Plugin, __abstractmethods__=set())
+@patch.object(pplugins.Plugin, 'run')
+def test_plugin_handle_control(_):
+    class PluginStub(pplugins.Plugin):
+        @pplugins.expose
+        def add(self, a, b):
+            return a + b
+
+        @pplugins.expose
+        def fail(self):
+            raise ValueError("bad value")
+
+        def hidden(self):
+            pass
+
+    q = queue.Queue()
+    plugin = PluginStub(pplugins.PluginInterface(None, q))
+
+    # application events aren't handled
+    assert plugin.handle_control('event') is False
+    assert q.empty()
+
+    assert plugin.handle_control(
+        pplugins.CallRequest(1, 'add', (1,), {'b': 2})) is True
+    response = q.get_nowait()
+    assert (response.call_id, response.result) == (1, 3)
+    assert response.error is None
+
+    plugin.handle_control(pplugins.CallRequest(2, 'fail', (), {}))
+    response = q.get_nowait()
+    assert 'bad value' in response.error
+
+    # only exposed methods may be called
+    plugin.handle_control(pplugins.CallRequest(3, 'hidden', (), {}))
+    assert 'No exposed method' in q.get_nowait().error
+
+
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_call(_):
+    pm = pplugins.PluginManager()
+    events, messages = queue.Queue(), queue.Queue()
+    pm.plugins = {'test': {'events': events, 'messages': messages}}
+
+    # plugin must be running
+    with pytest.raises(pplugins.PluginError):
+        pm.call('missing', 'method')
+
+    # pipelined calls are resolved by their own responses
+    first = pm.call('test', 'add', 1, b=2)
+    second = pm.call('test', 'fail')
+    request = events.get_nowait()
+    assert (request.method, request.args, request.kwargs) == \
+        ('add', (1,), {'b': 2})
+    messages.put(pplugins.CallResponse(events.get_nowait().call_id,
+                                       error="ValueError"))
+    messages.put(pplugins.CallResponse(request.call_id, result=3))
+
+    with patch.object(pplugins.PluginManager, '_process_message',
+                      return_value=None) as process_message_mock:
+        pm.process_messages()
+
+    process_message_mock.assert_not_called()
+    assert first.result(0) == 3
+    assert isinstance(second.exception(0), pplugins.PluginError)
+    assert pm.calls == {}
+
+    # cancelled calls are forgotten right away, timed out calls once
+    # messages are processed
+    timed_out = pm.call('test', 'method', timeout=0)
+    in_time = pm.call('test', 'method', timeout=60)
+    cancelled = pm.call('test', 'method', timeout=0)
+    cancelled.cancel()
+    assert set(pm.calls.values()) == {timed_out, in_time}
+
+    pm.process_messages()
+    assert 'timed out' in str(timed_out.exception(0))
+    assert cancelled.cancelled()
+    assert list(pm.calls.values()) == [in_time]
+    assert len(pm._deadlines) == 1
+
+    in_time.cancel()
+    assert pm.calls == {}
+
+    # calls fail when the plugin dies
+    future = pm.call('test', 'method')
+    pm._fail_calls('test', "Plugin terminated unexpectedly")
+    assert 'terminated' in str(future.exception(0))
+
+    # calls which can't be sent aren't left waiting
+    with patch.object(pplugins.PluginManager, 'send_event',
+                      side_effect=pplugins.PluginError("error", 'test')), \
+            pytest.raises(pplugins.PluginError):
+        pm.call('test', 'method', timeout=60)
+
+    assert pm.calls == {}
+
+
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+@patch.object(multiprocessing.Process, 'start', return_value=None)
+def test_pluginagent_handle(_):
+    agent = pplugins.PluginAgent(('127.0.0.1', 0), b'secret')
+    agent._handle([], 'start', ('foo',))
+    assert 'foo' in agent.plugins
+
+    # test plugin already running
+    with patch.object(multiprocessing.Process, 'is_alive', return_value=True):
+        with pytest.raises(pplugins.PluginError) as excinfo:
+            agent._handle([], 'start', ('foo',))
+
+    assert 'already running' in str(excinfo.value)
+
+    # events are delivered before the command runs, and messages are polled
+    agent.plugins['foo']['events'] = queue.Queue()
+    agent.plugins['foo']['messages'] = queue.Queue()
+    agent.plugins['foo']['messages'].put('message')
+    status = agent._handle([('foo', 'event'), ('bar', 'event')], 'poll', ())
+    assert agent.plugins['foo']['events'].get_nowait() == 'event'
+    assert status == {'foo': (None, ['message'])}
+
+    # terminated plugins are forgotten once polled
+    with patch.object(multiprocessing.Process, 'exitcode', 1):
+        status = agent._handle([], 'poll', ())
+
+    assert status == {'foo': (1, [])}
+    assert agent.plugins == {}
+
+
+class ConnectionStub(object):
+    def __init__(self, responses):
+        self.sent = []
+        self.responses = responses
+        self.closed = False
+
+    def send(self, obj):
+        self.sent.append(obj)
+
+    def recv(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+def test_remotehost_request():
+    host = pplugins.RemoteHost(('127.0.0.1', 0), b'secret', batch_size=2)
+    conn = ConnectionStub([(True, None), (True, 'value'), (False, 'error')])
+
+    with patch.object(pplugins, 'Client', return_value=conn) as client_mock:
+        # events are batched until the batch is full
+        host.put_event('foo', 1)
+        assert conn.sent == []
+        host.put_event('foo', 2)
+        assert conn.sent == [([('foo', 1), ('foo', 2)], 'ping', ())]
+
+        # connections are reused
+        assert host.request('poll') == 'value'
+        with pytest.raises(pplugins.PluginError):
+            host.request('start', 'foo')
+
+    client_mock.assert_called_once_with(('127.0.0.1', 0), authkey=b'secret')
+
+    # reconnect after a dropped connection, resending pending events
+    host.pool = [ConnectionStub([EOFError()])]
+    host.pending = [('foo', 3)]
+    conn = ConnectionStub([(True, 'value')])
+    with patch.object(pplugins, 'Client', return_value=conn):
+        assert host.request('poll') == 'value'
+
+    assert conn.sent == [([('foo', 3)], 'poll', ())]
+
+    # give up after too many retries
+    def dropped_connection(*args, **kwargs):
+        return ConnectionStub([IOError()])
+
+    host.pool = []
+    with patch.object(pplugins, 'Client', side_effect=dropped_connection):
+        with pytest.raises(pplugins.PluginError) as excinfo:
+            host.request('poll')
+
+    assert 'Unable to reach' in str(excinfo.value)
+
+    # commands the agent may have run aren't sent again
+    with patch.object(pplugins, 'Client',
+                      side_effect=dropped_connection) as client_mock:
+        with pytest.raises(pplugins.PluginError) as excinfo:
+            host.request('start', 'foo')
+
+    client_mock.assert_called_once_with(('127.0.0.1', 0), authkey=b'secret')
+    assert 'during start' in str(excinfo.value)
+
+    # events which couldn't be sent are kept for the next request
+    host.pending = [('foo', 4)]
+    with patch.object(pplugins, 'Client', side_effect=IOError) as client_mock:
+        with pytest.raises(pplugins.PluginError):
+            host.request('poll')
+
+    assert client_mock.call_count == host.retries + 1
+    assert host.pending == [('foo', 4)]
+
+
+@patch.multiple(pplugins.RemotePluginManager, __abstractmethods__=set())
+def test_remotepluginmanager():
+    pm = pplugins.RemotePluginManager([(('127.0.0.1', 1), b'secret'),
+                                       (('127.0.0.1', 2), b'secret')])
+
+    # plugins are spread across hosts
+    status = {'foo': (None, []), 'bar': (None, [])}
+    with patch.object(pplugins.RemoteHost, 'request', return_value=status):
+        pm.start_plugin('foo')
+        pm.start_plugin('bar')
+
+    assert pm.plugins['foo']['host'] is not pm.plugins['bar']['host']
+    assert pm.plugins['foo']['process'].is_alive()
+
+    # messages and status are collected with one poll per host
+    status = {'foo': (None, ['message'])}
+    with patch.object(pplugins.RemoteHost, 'request',
+                      return_value=status) as request_mock:
+        pm.reap_plugins()
+
+    assert request_mock.call_count == 2
+    assert pm.plugins['foo']['messages'].get_nowait() == 'message'
+    assert list(pm.plugins) == ['foo']
+
+    # plugins keep running while an agent is briefly unreachable
+    with patch.object(pplugins.RemoteHost, 'request',
+                      side_effect=pplugins.PluginError("error", None)):
+        pm.reap_plugins()
+        pm.reap_plugins()
+
+    assert list(pm.plugins) == ['foo']
+
+    # a successful poll resets the count of failures
+    with patch.object(pplugins.RemoteHost, 'request', return_value=status):
+        pm.reap_plugins()
+
+    with patch.object(pplugins.RemoteHost, 'request',
+                      side_effect=pplugins.PluginError("error", None)):
+        pm.reap_plugins()
+        pm.reap_plugins()
+        assert list(pm.plugins) == ['foo']
+
+        # plugins on hosts unreachable for too long are reaped
+        pm.reap_plugins()
+
+    assert pm.plugins == {}
+
+
+class EchoRemotePluginManager(pplugins.RemotePluginManager):
+    def __init__(self, *args, **kwargs):
+        super(EchoRemotePluginManager, self).__init__(*args, **kwargs)
+
+        self.received = []
+
+    def _stop_plugin(self, name):
+        self.plugins[name]['events'].put(None)
+        self.plugins[name]['process'].join(10)
+
+    def _process_message(self, plugin, message):
+        self.received.append(message)
+
+
+def test_remotepluginmanager_agent():
+    agent = pplugins.PluginAgent(('127.0.0.1', 0), b'secret')
+    agent.plugin_runner = pplugins_bench.BenchPluginRunner
+    agent.start()
+    assert agent.address[1] != 0
+
+    thread = threading.Thread(target=agent.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    pm = EchoRemotePluginManager([(agent.address, b'secret')])
+    try:
+        pm.start_plugin('echo')
+
+        # events are delivered, and messages collected by polling
+        pm.send_event('echo', 'event')
+        future = pm.call('echo', 'echo', 'called')
+
+        deadline = time.time() + 10
+        while not future.done() and time.time() < deadline:
+            pm.reap_plugins()
+            pm.process_messages()
+            time.sleep(0.01)
+
+        assert pm.received == ['event']
+        assert future.result(0) == 'called'
+
+        pm.stop_plugin('echo')
+        assert pm.plugins == {}
+
+        # the agent forgets the plugin once its exit has been polled
+        assert pm.hosts[0].request('poll') == {'echo': (0, [])}
+        assert pm.hosts[0].request('poll') == {}
+    finally:
+        for host in pm.hosts:
+            host.close()
+
+        agent.close()
+        thread.join(10)
+
+    assert not thread.is_alive()
+
+
+@patch.multiple(pplugins.Plugin, __abstractmethods__=set())
+@patch.object(pplugins.Plugin, 'run')
+@patch.object(threading, 'Timer')
+def test_plugin_profiling(timer_mock, _):
+    events, messages = queue.Queue(), queue.Queue()
+    plugin = pplugins.Plugin(pplugins.PluginInterface(events, messages))
+
+    for kind in ('cprofile', 'sample', 'tracemalloc'):
+        assert plugin.handle_control(pplugins.ProfileRequest(kind, 5, 0.001))
+        assert timer_mock.call_args[0] == (5, events.put)
+
+        # only one profiler runs at a time
+        plugin.handle_control(pplugins.ProfileRequest('cprofile', 5))
+        assert 'Already profiling' in messages.get_nowait().error
+
+        assert plugin.handle_control(pplugins.StopProfiling())
+        result = messages.get_nowait()
+        assert result.kind == kind
+        assert result.error is None
+        assert result.data is not None
+
+    # stopping twice does nothing
+    plugin.handle_control(pplugins.StopProfiling())
+    assert messages.empty()
+
+    plugin.handle_control(pplugins.ProfileRequest('bogus', 5))
+    assert 'Unsupported' in messages.get_nowait().error
+
+
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_profile_plugin(_, tmpdir):
+    pm = pplugins.PluginManager()
+    pm.profile_dir = str(tmpdir)
+    events, messages = queue.Queue(), queue.Queue()
+    pm.plugins = {'test': {'events': events, 'messages': messages}}
+
+    with pytest.raises(pplugins.PluginError):
+        pm.profile_plugin('missing')
+
+    pm.profile_plugin('test', 'sample', duration=1)
+    request = events.get_nowait()
+    assert (request.kind, request.duration) == ('sample', 1)
+
+    # results are saved, not passed to _process_message()
+    messages.put(pplugins.ProfileResult('sample', {'a;b': 2, 'a': 1}))
+    messages.put(pplugins.ProfileResult('cprofile', {('f', 1, 'g'): 1}))
+    messages.put(pplugins.ProfileResult('cprofile', error='error'))
+    pm.process_messages()
+
+    collapsed, = tmpdir.listdir('*.collapsed')
+    assert collapsed.read() == "a 1\na;b 2\n"
+    assert len(tmpdir.listdir('*.pstats')) == 1
+
+
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_share_data(tmpdir):
+    path = tmpdir.join('data.bin')
+    path.write_binary(b'file data')
+
+    pm = pplugins.PluginManager()
+    with pytest.raises(ValueError):
+        pm.share_data('invalid')
+
+    pm.share_data('file', path=str(path))
+    pm.share_data('memory', data=b'memory data')
+    assert pm.shared_data['file'] == ('file', str(path))
+    assert pm.shared_data['memory'][0] == 'memory'
+
+    # plugins attach to shared data without being able to modify it
+    interface = pplugins.PluginInterface(None, None, dict(pm.shared_data))
+    assert interface.attach('file')[:] == b'file data'
+    memory = interface.attach('memory')
+    assert bytes(memory[:11]) == b'memory data'
+    assert interface.attach('memory') is memory
+    with pytest.raises(TypeError):
+        memory[0] = 0
+
+    with pytest.raises(KeyError):
+        interface.attach('missing')
+
+    interface.detach()
+    with pytest.raises(ValueError):
+        memory[0]
+
+    pm.unshare_data('file')
+    pm.unshare_data('memory')
+    assert pm.shared_data == {}
+    assert pm._shared_memory == {}
+
+
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+@patch.object(multiprocessing.Process, 'start', return_value=None)
+def test_pluginmanager_freeze_gc(_, __):
+    pm = pplugins.PluginManager()
+    pm.freeze_gc = True
+    pm.shared_data = {'data': ('file', 'data.bin')}
+
+    with patch('gc.freeze', create=True) as freeze_mock, \
+        patch('gc.unfreeze', create=True) as unfreeze_mock, \
+        patch('gc.collect') as collect_mock, \
+        patch('multiprocessing.get_start_method', return_value='fork'), \
+        patch.object(pplugins.PluginManager, '_stop_plugin'), \
+            patch.object(multiprocessing.Process, 'is_alive',
+                         return_value=False):
+        pm.start_plugin('foo')
+        pm.start_plugin('bar')
+
+        # garbage is only collected before the first freeze, and the parent
+        # stays frozen while plugins share its memory
+        collect_mock.assert_called_once_with()
+        assert freeze_mock.call_count == 2
+        pm.stop_plugin('foo')
+        unfreeze_mock.assert_not_called()
+
+        pm.stop_plugin('bar')
+        unfreeze_mock.assert_called_once_with()
+
+    # plugins that aren't forked don't share the parent's memory
+    pm.start_method = 'spawn'
+    with patch('gc.freeze', create=True) as freeze_mock:
+        pm.start_plugin('baz')
+
+    freeze_mock.assert_not_called()
+    assert pm.plugins['baz']['process'].shared_data == pm.shared_data
+
+
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_memory_usage():
+    pm = pplugins.PluginManager()
+    process = multiprocessing.Process()
+    pm.plugins = {'test': {'process': process}}
+
+    # not started
+    assert pm.memory_usage('test') is None
+
+    with patch.object(multiprocessing.Process, 'pid', os.getpid()):
+        usage = pm.memory_usage('test')
+
+    if os.path.exists('/proc/self/smaps_rollup'):
+        assert 0 < usage['uss'] <= usage['pss'] <= usage['rss']
+
+
+def test_trafficrecorder(tmpdir):
+    path = str(tmpdir.join('traffic.log'))
+
+    recorder = pplugins.TrafficRecorder(path)
+    recorder.record(pplugins.TrafficRecorder.EVENT, 'foo', {'event': 1})
+    recorder.record(pplugins.TrafficRecorder.MESSAGE, u'b\xe4r', b'message')
+    recorder.close()
+
+    # records written after closing are dropped
+    recorder.record(pplugins.TrafficRecorder.EVENT, 'foo', None)
+
+    records = list(pplugins.read_recording(path))
+    assert [record[1:] for record in records] == [
+        (pplugins.TrafficRecorder.EVENT, 'foo', {'event': 1}),
+        (pplugins.TrafficRecorder.MESSAGE, u'b\xe4r', b'message'),
+    ]
+    assert records[0][0] <= records[1][0]
+
+    # a truncated final record ends the log
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-1])
+
+    assert [record[1:] for record in pplugins.read_recording(path)] == [
+        (pplugins.TrafficRecorder.EVENT, 'foo', {'event': 1}),
+    ]
+
+    # records are written to disk while recording
+    with patch.object(pplugins.TrafficRecorder, 'flush_interval', 0):
+        recorder = pplugins.TrafficRecorder(path)
+        recorder.record(pplugins.TrafficRecorder.EVENT, 'foo', 1)
+
+    assert len(list(pplugins.read_recording(path))) == 1
+    recorder.close()
+
+    tmpdir.join('other').write('other')
+    with pytest.raises(ValueError):
+        list(pplugins.read_recording(str(tmpdir.join('other'))))
+
+
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_recording(_, tmpdir):
+    path = str(tmpdir.join('traffic.log'))
+    pm = pplugins.PluginManager()
+    events, messages = queue.Queue(), queue.Queue()
+    pm.plugins = {'test': {'events': events, 'messages': messages}}
+
+    # not recording
+    pm.send_event('test', 'before')
+    assert events.get_nowait() == 'before'
+
+    pm.start_recording(path)
+    pm.send_event('test', 'event')
+    future = pm.call('test', 'method')
+    assert events.get_nowait() == 'event'
+    messages.put('message')
+    messages.put(pplugins.CallResponse(events.get_nowait().call_id))
+    with patch.object(pplugins.PluginManager, '_process_message',
+                      return_value=None):
+        pm.process_messages()
+    pm.stop_recording()
+    pm.stop_recording()
+
+    assert future.done()
+    records = [record[1:3] for record in pplugins.read_recording(path)]
+    assert records == [
+        (pplugins.TrafficRecorder.EVENT, 'test'),
+        (pplugins.TrafficRecorder.EVENT, 'test'),
+        (pplugins.TrafficRecorder.MESSAGE, 'test'),
+        (pplugins.TrafficRecorder.MESSAGE, 'test'),
+    ]
+
+
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+def test_pluginmanager_context(_):
+    # the default context is used unless one is given
+    pm = pplugins.PluginManager()
+    assert pm.context is multiprocessing
+    assert pm.start_method is None
+
+    with patch.object(multiprocessing.get_context('spawn'),
+                      'set_forkserver_preload') as preload_mock:
+        pm = pplugins.PluginManager('spawn', preload=('json',))
+
+    preload_mock.assert_called_once_with(['json'])
+    assert pm.context is multiprocessing.get_context('spawn')
+
+    # queues and processes are created with the context
+    with patch.object(pm.context, 'Queue') as queue_mock, \
+            patch.object(multiprocessing.Process, 'start', return_value=None):
+        pm.start_plugin('foo')
+
+    assert queue_mock.call_count == 2
+    assert pm.plugins['foo']['process'].start_method == 'spawn'
+    assert pm.plugins['foo']['start_time'] <= time.time()
+
+    # the process is started with its start method
+    process = pm.plugins['foo']['process']
+    with patch.object(multiprocessing.get_context('spawn').Process,
+                      '_Popen') as popen_mock:
+        process._Popen(process)
+
+    popen_mock.assert_called_once_with(process)
+
+
+@patch.multiple(pplugins.Plugin, __abstractmethods__=set())
+@patch.object(pplugins.Plugin, 'run')
+def test_plugin_report_startup(_):
+    q = queue.Queue()
+    interface = pplugins.PluginInterface(None, q)
+
+    # nothing is reported unless the runner set start up times
+    pplugins.Plugin(interface)
+    assert q.empty()
+
+    interface.startup = (1.0, 2.0)
+    pplugins.Plugin(interface)
+    report = q.get_nowait()
+    assert (report.started, report.imported) == (1.0, 2.0)
+    assert report.initialized >= 2.0
+
+    # only reported once
+    interface.report_startup()
+    assert q.empty()
+
+    # event loop plugins are ready once they wait for events
+    class ReadyPluginStub(EventLoopPluginStub):
+        def __init__(self, interface):
+            self.reported = []
+            super(ReadyPluginStub, self).__init__(interface)
+
+        def report_ready(self):
+            self.reported.append(self.interface.events.qsize())
+            super(ReadyPluginStub, self).report_ready()
+
+    events = queue.Queue()
+    events.put(None)
+    interface = pplugins.PluginInterface(events, q)
+    interface.startup = (1.0, 2.0)
+
+    plugin = ReadyPluginStub(interface)
+    assert plugin.reported == [1]
+    assert q.get_nowait().initialized >= 2.0
+
+
+@patch.object(pplugins.PluginManager, 'reap_plugins', return_value=None)
+@patch.multiple(pplugins.PluginManager, __abstractmethods__=set())
+def test_pluginmanager_record_startup(_):
+    pm = pplugins.PluginManager()
+    q = queue.Queue()
+    pm.plugins = {'test': {'messages': q, 'start_time': 1.0}}
+
+    q.put(pplugins.StartupReport(1.5, 3.0, 3.25))
+    pm.process_messages()
+
+    assert pm.plugins['test']['startup'] == \
+        {'spawn': 0.5, 'import': 1.5, 'init': 0.25}
+
+
+class EventLoopPluginStub(pplugins.EventLoopPlugin):
+    def __init__(self, interface):
+        self.handled = []
+        self.batches = []
+        self.ticks = 0
+
+        super(EventLoopPluginStub, self).__init__(interface)
+
+    @pplugins.handles(int, float)
+    def handle_number(self, event):
+        self.handled.append(('number', event))
+
+    @pplugins.handles(str)
+    def handle_str(self, event):
+        self.handled.append(('str', event))
+
+    def handle_unknown(self, event):
+        self.handled.append(('unknown', event))
+
+    def handle_batch(self, events):
+        self.batches.append(list(events))
+        super(EventLoopPluginStub, self).handle_batch(events)
+
+    def tick(self):
+        self.ticks += 1
+
+
+def test_eventloopplugin():
+    events, messages = queue.Queue(), queue.Queue()
+    for event in (1, 'a', 2.5, b'b', pplugins.CallRequest(1, 'x', (), {}),
+                  None, 'after stop'):
+        events.put(event)
+
+    plugin = EventLoopPluginStub(pplugins.PluginInterface(events, messages))
+
+    assert plugin.handled == [('number', 1), ('str', 'a'), ('number', 2.5),
+                              ('unknown', b'b')]
+
+    # framework events are handled, and events after the stop are left
+    assert 'No exposed method' in messages.get_nowait().error
+    assert events.get_nowait() == 'after stop'
+    assert plugin.ticks == 0
+
+
+def test_eventloopplugin_batches():
+    events = queue.Queue()
+    for event in range(5):
+        events.put(event)
+    events.put(None)
+
+    class BatchPluginStub(EventLoopPluginStub):
+        batch_size = 2
+
+    plugin = BatchPluginStub(pplugins.PluginInterface(events, queue.Queue()))
+
+    assert plugin.batches == [[0, 1], [2, 3], [4]]
+
+
+def test_eventloopplugin_batch_order():
+    events, messages = queue.Queue(), queue.Queue()
+    for event in ('a', pplugins.CallRequest(1, 'call', (), {}), 'b', None,
+                  'after stop'):
+        events.put(event)
+
+    class BatchPluginStub(EventLoopPluginStub):
+        batch_size = 10
+
+        @pplugins.expose
+        def call(self):
+            self.handled.append(('call', None))
+
+    plugin = BatchPluginStub(pplugins.PluginInterface(events, messages))
+
+    # events are handled in the order they were sent
+    assert plugin.handled == [('str', 'a'), ('call', None), ('str', 'b')]
+    assert plugin.batches == [['a'], ['b']]
+
+    # events after the stop aren't taken from the queue
+    assert events.get_nowait() == 'after stop'
+
+
+def test_eventloopplugin_ticks():
+    class TickPluginStub(EventLoopPluginStub):
+        tick_interval = 0.01
+
+        def tick(self):
+            super(TickPluginStub, self).tick()
+
+            if self.ticks == 3:
+                self.interface.events.put(None)
+
+    plugin = TickPluginStub(pplugins.PluginInterface(queue.Queue(), None))
+
+    assert plugin.ticks == 3
+    assert plugin.handled == []
+
+
+@patch.multiple(pplugins.PluginRunner, __abstractmethods__=set())
+def test_pluginrunner_is_plugin():
+    pr = pplugins.PluginRunner(None, None, None)
+
+    class IndirectPluginStub(EventLoopPluginStub):
+        pass
+
+    assert pr._is_plugin(EventLoopPluginStub)
+    assert not pr._is_plugin(IndirectPluginStub)
+    assert not pr._is_plugin(pplugins.Plugin)
+    assert not pr._is_plugin(pplugins.EventLoopPlugin)
+    assert not pr._is_plugin(object)
@@ -0,0 +1,74 @@
+import pytest
+from mock import Mock, patch
+
+import pplugins
+import pplugins_bench
+
+
+def test_percentile():
+    samples = list(range(100, 0, -1))
+
+    assert pplugins_bench.percentile(samples, 0) == 1
+    assert pplugins_bench.percentile(samples, 50) == 51
+    assert pplugins_bench.percentile(samples, 100) == 100
+    assert pplugins_bench.percentile([5], 99) == 5
+
+
+def test_compare():
+    baseline = {
+        'round_trip_p50_us': 100,
+        'throughput_64b_per_sec': 1000,
+        'removed_us': 1,
+    }
+
+    # within tolerance, or improved
+    results = {
+        'round_trip_p50_us': 105,
+        'throughput_64b_per_sec': 2000,
+        'added_us': 1,
+    }
+    assert pplugins_bench.compare(results, baseline, 0.1) == []
+
+    # latency regresses when it grows, throughput when it shrinks
+    results = {'round_trip_p50_us': 120, 'throughput_64b_per_sec': 800}
+    assert pplugins_bench.compare(results, baseline, 0.1) == [
+        ('round_trip_p50_us', 100, 120),
+        ('throughput_64b_per_sec', 1000, 800),
+    ]
+
+
+def test_parse_args():
+    args = pplugins_bench.parse_args(['--plugin-counts', '1,2',
+                                      '--payload-sizes', '8'])
+
+    assert args.plugin_counts == [1, 2]
+    assert args.payload_sizes == [8]
+    assert args.baseline is None
+
+
+def test_wait_timeouts():
+    manager = pplugins_bench.BenchPluginManager()
+
+    # plugins that die or never respond don't hang the benchmarks
+    with pytest.raises(pplugins.PluginError):
+        manager.wait_for_messages(1, timeout=0)
+
+    process = Mock()
+    process.is_alive.return_value = False
+    manager.plugins['echo'] = {'process': process}
+    with pytest.raises(pplugins.PluginError) as excinfo:
+        manager.wait_for_startup('echo')
+
+    assert excinfo.value.plugin == 'echo'
+
+
+def test_max_plugins():
+    with patch.object(pplugins_bench, 'resource') as resource_mock:
+        resource_mock.getrlimit.return_value = (1024, 4096)
+        pplugins_bench.raise_file_limit()
+        resource_mock.setrlimit.assert_called_once_with(
+            resource_mock.RLIMIT_NOFILE, (4096, 4096))
+
+        # counts that don't fit in the limit are skipped
+        assert pplugins_bench.max_plugins() == \
+            (1024 - 64) // pplugins_bench.FILES_PER_PLUGIN
@@ -0,0 +1,69 @@
+import pplugins
+import pplugins_bench
+import pplugins_replay
+
+
+def record(path):
+    recorder = pplugins.TrafficRecorder(path)
+    recorder.record(pplugins.TrafficRecorder.MESSAGE, 'echo',
+                    pplugins.StartupReport(0.0, 0.0, 0.0))
+    for i in range(20):
+        recorder.record(pplugins.TrafficRecorder.EVENT, 'echo', i)
+        recorder.record(pplugins.TrafficRecorder.EVENT, 'other', i)
+        recorder.record(pplugins.TrafficRecorder.MESSAGE, 'echo', i)
+    recorder.close()
+
+
+def test_load_events(tmpdir):
+    path = str(tmpdir.join('traffic.log'))
+    record(path)
+
+    events, messages = pplugins_replay.load_events(path, 'echo')
+    assert messages == 20
+    assert [(sent, event) for _, sent, event in events] == \
+        [(i, i) for i in range(20)]
+
+
+def test_replay(tmpdir):
+    path = str(tmpdir.join('traffic.log'))
+    record(path)
+
+    events, messages = pplugins_replay.load_events(path, 'echo')
+    stats = pplugins_replay.replay(pplugins_bench.BenchPluginRunner, 'echo',
+                                   events, messages, speed=0)
+
+    assert stats['events'] == 20
+    assert stats['messages'] == stats['expected_messages'] == 20
+    assert stats['events_per_sec'] > 0
+    assert 0 < stats['latency_p50_ms'] <= stats['latency_p99_ms']
+
+
+def test_replay_framework_messages():
+    # only messages from the plugin itself are responses to events
+    class PluginRunnerStub(object):
+        def __init__(self, plugin, event_queue, message_queue):
+            message_queue.put(pplugins.StartupReport(0.0, 0.0, 0.0))
+            message_queue.put(pplugins.CallResponse(0, result=1))
+            message_queue.put(pplugins.ProfileResult('cprofile', b''))
+            message_queue.put('response')
+
+        def start(self):
+            pass
+
+        def terminate(self):
+            pass
+
+        def join(self):
+            pass
+
+    stats = pplugins_replay.replay(PluginRunnerStub, 'echo',
+                                   [(0.0, 0, 'event')], 1, speed=0,
+                                   drain=0.1)
+
+    assert stats['messages'] == 1
+    assert stats['latency_p50_ms'] is not None
+
+
+def test_load_runner():
+    assert pplugins_replay.load_runner('pplugins_bench:BenchPluginRunner') \
+        is pplugins_bench.BenchPluginRunner